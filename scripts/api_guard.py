@@ -0,0 +1,159 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import random
+import threading
+import time
+
+from metrics import THROTTLING_ERROR_CODES
+
+DEFAULT_MAX_ATTEMPTS = 8
+BASE_BACKOFF_SECONDS = 0.1
+MAX_BACKOFF_SECONDS = 20.0
+# Concurrency is halved at most once per interval, so a burst of throttled calls that were all in flight together
+# counts as a single signal.
+DECREASE_INTERVAL_SECONDS = 1.0
+TRANSIENT_ERROR_CODES = {'RequestTimeout', 'RequestTimeoutException', 'InternalError', 'InternalFailure',
+                         'ServiceUnavailable', 'ServiceUnavailableException', 'PriorRequestNotComplete'}
+
+
+def parse_rate_limit(value):
+    # A rate limit is given as OPERATION=REQUESTS_PER_SECOND, such as GetObject=3000 or FilterLogEvents=5.
+    operation, _, rate = value.partition('=')
+    try:
+        rate = float(rate)
+    except ValueError:
+        rate = 0
+    if not operation.strip() or rate <= 0:
+        raise ValueError('Invalid rate limit [{0}], expected OPERATION=REQUESTS_PER_SECOND'.format(value))
+    return operation.strip(), rate
+
+
+class TokenBucket:
+    # Allows `rate` calls per second on average, and bursts of up to `capacity` calls after a quiet period.
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens = self.tokens - 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveConcurrency:
+    # Caps the calls in flight with additive increase, multiplicative decrease: every throttled call halves the limit,
+    # and every successful one raises it by 1/limit, i.e. by one call per limit's worth of successes. Other failures
+    # leave it as it is.
+    def __init__(self, max_limit, min_limit=1):
+        self.max_limit = max(max_limit, min_limit)
+        self.min_limit = min_limit
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self._condition = threading.Condition()
+        self._last_decrease = 0.0
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight = self.in_flight + 1
+
+    def release(self, throttled=False, succeeded=True):
+        with self._condition:
+            self.in_flight = self.in_flight - 1
+            if throttled:
+                now = time.monotonic()
+                if now - self._last_decrease >= DECREASE_INTERVAL_SECONDS:
+                    self.limit = max(float(self.min_limit), self.limit / 2)
+                    self._last_decrease = now
+            elif succeeded:
+                self.limit = min(float(self.max_limit), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class ApiGuard:
+    # One shared layer in front of every AWS SDK client of a run. Before each attempt, a call waits for a token of its
+    # operation's rate limit and for a slot of its service's adaptive concurrency limit. After each attempt, throttling,
+    # server errors and connection errors are retried with exponential backoff and full jitter, up to max_attempts.
+    # It hooks the SDK's before-send and needs-retry events, so retries stay within a single SDK call.
+    # The AWS SDK's own retries have to be switched off on guarded clients, since the guard makes every retry decision.
+    sdk_retries = {'total_max_attempts': 1}
+
+    def __init__(self, max_concurrency, rate_limits=None, max_attempts=DEFAULT_MAX_ATTEMPTS, rng=None):
+        if max_attempts < 1:
+            raise ValueError('max_attempts must be at least 1')
+        self.max_concurrency = max_concurrency
+        self.max_attempts = max_attempts
+        self.buckets = dict((operation, TokenBucket(rate)) for operation, rate in (rate_limits or {}).items())
+        self.rng = rng or random.Random()
+        self._limiters = dict()
+        self._lock = threading.Lock()
+        self._held = threading.local()
+
+    def get_limiter(self, service):
+        with self._lock:
+            if service not in self._limiters:
+                self._limiters[service] = AdaptiveConcurrency(self.max_concurrency)
+            return self._limiters[service]
+
+    def attach(self, client):
+        client.meta.events.register('before-send', self._before_send)
+        client.meta.events.register('needs-retry', self._needs_retry)
+        return client
+
+    def _before_send(self, event_name=None, **kwargs):
+        _, service, operation = event_name.split('.', 2)
+        if operation in self.buckets:
+            self.buckets[operation].acquire()
+        self.get_limiter(service).acquire()
+        self._held.service = service
+
+    def _needs_retry(self, event_name=None, attempts=1, response=None, caught_exception=None, **kwargs):
+        error_code = response[1].get('Error', {}).get('Code') if response is not None else None
+        throttled = error_code in THROTTLING_ERROR_CODES
+        service = getattr(self._held, 'service', None)
+        if service is not None:
+            self._held.service = None
+            self.get_limiter(service).release(throttled, error_code is None and caught_exception is None)
+
+        if not self.is_retryable(response, caught_exception, error_code) or attempts >= self.max_attempts:
+            return None
+        # Full jitter spreads out the retries of calls that were throttled together.
+        return self.rng.uniform(0, min(MAX_BACKOFF_SECONDS, BASE_BACKOFF_SECONDS * 2 ** (attempts - 1)))
+
+    @staticmethod
+    def is_retryable(response, caught_exception, error_code):
+        if caught_exception is not None:
+            # Connection errors and timeouts; anything else is a bug that a retry will not fix.
+            from botocore.exceptions import ConnectionError, HTTPClientError
+
+            return isinstance(caught_exception, (ConnectionError, HTTPClientError))
+        if error_code in THROTTLING_ERROR_CODES or error_code in TRANSIENT_ERROR_CODES:
+            return True
+        return response is not None and response[0].status_code >= 500
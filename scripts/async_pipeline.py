@@ -0,0 +1,112 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import asyncio
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+from pipeline import DEFAULT_CONCURRENCY
+
+
+class _Page:
+    def __init__(self, items):
+        self.items = items
+        self.remaining = len(items)
+
+
+class AsyncPipeline:
+    # Runs a coroutine for every listed item on an asyncio event loop. The AWS SDK is blocking, so each API call is
+    # handed to a thread pool through call(), and at most `concurrency` calls are in flight at any time. The number of
+    # items being worked on is capped separately by max_in_flight, which bounds memory.
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY, max_in_flight=None, metrics=None, dead_letter=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight or concurrency * 2
+        self.metrics = metrics
+        self.dead_letter = dead_letter
+        self.processed_keys = 0
+        self.failed_keys = 0
+        self._executor = None
+        self._api_slots = None
+        self._pages = collections.deque()
+        self._page_lock = None
+
+    async def call(self, function, *args):
+        async with self._api_slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, function, *args)
+
+    async def run(self, pages, process, on_page_start=None, on_page_done=None):
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency + 1, thread_name_prefix='async-pipeline')
+        self._api_slots = asyncio.Semaphore(self.concurrency)
+        self._page_lock = asyncio.Lock()
+        in_flight = asyncio.Semaphore(self.max_in_flight)
+        tasks = set()
+        listing = iter(pages)
+        try:
+            while True:
+                # Listing is blocking as well, and runs while earlier items are still being worked on.
+                items = await self.call(next, listing, None)
+                if items is None:
+                    break
+                if on_page_start is not None:
+                    await on_page_start(items)
+
+                page = _Page(items)
+                self._pages.append(page)
+                await self._complete_pages(on_page_done)
+                for item in items:
+                    await in_flight.acquire()
+                    task = asyncio.ensure_future(self._process(page, item, process, in_flight, on_page_done))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+
+            if tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._executor.shutdown(wait=True)
+        return self.processed_keys, self.failed_keys
+
+    async def _process(self, page, item, process, in_flight, on_page_done):
+        try:
+            await process(item)
+        except Exception as error:
+            self.failed_keys = self.failed_keys + 1
+            print('[ERROR] Failed to process key [{0}]: {1}'.format(item.get('Key'), error))
+            if self.dead_letter is not None:
+                self.dead_letter.record(item, error)
+            if self.metrics is not None:
+                self.metrics.add('items_failed')
+        else:
+            self.processed_keys = self.processed_keys + 1
+            if self.metrics is not None:
+                self.metrics.add('items_processed')
+        finally:
+            page.remaining = page.remaining - 1
+            in_flight.release()
+        await self._complete_pages(on_page_done)
+
+    async def _complete_pages(self, on_page_done):
+        # Report pages strictly in listing order, once every item on the page has either been written or failed.
+        async with self._page_lock:
+            while self._pages and self._pages[0].remaining == 0:
+                page = self._pages.popleft()
+                if on_page_done is not None:
+                    await on_page_done(page.items)
@@ -0,0 +1,324 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import connect_chat_to_lex_transcripts
+import stitch_conversation_logs_and_contact_lens_transcripts
+import synthetic_transcripts
+import transcribe_call_analytics_to_lex_transcripts
+from json_codec import DEFAULT_JSON_CODEC, JSON_CODECS
+from lex_log_export_index import LexLogExportIndex
+from output_sink import DEFAULT_OUTPUT_COMPRESSION, OUTPUT_COMPRESSIONS
+from storage import LocalStorage
+
+BENCHMARKS = ['connect_chat_convert', 'call_analytics_convert', 'stitch',
+              'connect_chat_pipeline', 'call_analytics_pipeline', 'stitch_pipeline']
+
+
+def get_percentile(sorted_values, percentile):
+    # Nearest-rank percentile of an already sorted list.
+    if not sorted_values:
+        return None
+    index = max(int(round(percentile / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+
+def summarize(items, seconds, latencies=None, peak_memory=None, stage_latencies=None):
+    result = {'items': items,
+              'seconds': round(seconds, 6),
+              'items_per_second': round(items / seconds, 2) if seconds > 0 else None,
+              'peak_memory_bytes': peak_memory}
+    if latencies:
+        latencies = sorted(latency * 1000 for latency in latencies)
+        result['latency_ms'] = {'p50': round(get_percentile(latencies, 50), 4),
+                                'p90': round(get_percentile(latencies, 90), 4),
+                                'p99': round(get_percentile(latencies, 99), 4),
+                                'max': round(latencies[-1], 4)}
+    if stage_latencies:
+        result['stage_latency_ms'] = stage_latencies
+    return result
+
+
+def read_stage_latencies(metrics_path):
+    # Per-item latency of every stage of an end-to-end run, from the histograms in its metrics file. Percentiles are
+    # the upper bounds of the histogram buckets they fall in, capped at the slowest item seen.
+    with open(metrics_path, 'r', encoding='utf-8') as metrics_file:
+        stages = json.load(metrics_file)['stages']
+
+    def to_milliseconds(seconds, max_seconds):
+        if seconds is None:
+            return None
+        return round(min(seconds, max_seconds) * 1000, 4)
+
+    return {stage: {'p50': to_milliseconds(histogram['p50_seconds'], histogram['max_seconds']),
+                    'p99': to_milliseconds(histogram['p99_seconds'], histogram['max_seconds']),
+                    'max': to_milliseconds(histogram['max_seconds'], histogram['max_seconds'])}
+            for stage, histogram in stages.items()}
+
+
+def time_each(function, payloads):
+    latencies = []
+    start = time.perf_counter()
+    for payload in payloads:
+        item_start = time.perf_counter()
+        function(payload)
+        latencies.append(time.perf_counter() - item_start)
+    return time.perf_counter() - start, latencies
+
+
+def measure_peak_memory(function):
+    # A separate pass, since tracing allocations slows down the timed one considerably.
+    tracemalloc.start()
+    try:
+        function()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def run_main(module, arguments):
+    # Run a script's entry point as if it was called from the command line, with its progress output silenced. A run
+    # that reports failures raises, so it is never timed as if it was valid throughput.
+    original_arguments = sys.argv
+    sys.argv = [module.__file__] + arguments
+    output = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(output):
+            exit_code = module.main()
+    finally:
+        sys.argv = original_arguments
+    if exit_code:
+        raise RuntimeError('{0} exited with [{1}]:\n{2}'.format(module.__name__, exit_code,
+                                                               '\n'.join(output.getvalue().splitlines()[-10:])))
+
+
+def benchmark_convert(converter, payloads):
+    def run():
+        return time_each(converter.convert_to_contact_lens_format, payloads)
+
+    seconds, latencies = run()
+    return summarize(len(payloads), seconds, latencies, measure_peak_memory(run))
+
+
+def build_stitch_fixture(directory, contact_lens_items):
+    # A local stand-in for the Contact Lens bucket and for an Amazon CloudWatch Logs export of the matching
+    # conversation logs, plus the offline index built from that export.
+    source = LocalStorage(os.path.join(directory, 'source'))
+    export = LocalStorage(os.path.join(directory, 'export'))
+    events = []
+    for key, contact_lens_json, lex_log_events in contact_lens_items:
+        source.put(key, json.dumps(contact_lens_json).encode('utf-8'))
+        events.extend(lex_log_events)
+    events.sort()
+    export.put('exportedlogs/000000', synthetic_transcripts.format_export_lines(events).encode('utf-8'))
+    index_path = os.path.join(directory, 'index.sqlite')
+    lex_log_index = LexLogExportIndex(index_path)
+    lex_log_index.ingest(export)
+    return source, index_path, lex_log_index
+
+
+def benchmark_stitch(contact_lens_items):
+    with tempfile.TemporaryDirectory() as directory:
+        source, index_path, lex_log_index = build_stitch_fixture(directory, contact_lens_items)
+        payloads = [(key, source.get(key).decode('utf-8')) for key, _, _ in contact_lens_items]
+
+        def stitch(payload):
+            key, data = payload
+            return stitch_conversation_logs_and_contact_lens_transcripts.stitch_conversation_logs(
+                data, key, None, None, lex_log_index)
+
+        def run():
+            return time_each(stitch, payloads)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            seconds, latencies = run()
+            peak_memory = measure_peak_memory(run)
+        lex_log_index.close()
+        return summarize(len(payloads), seconds, latencies, peak_memory)
+
+
+def benchmark_converter_pipeline(converter, payloads, concurrency, transform_processes, json_codec, output_arguments):
+    with tempfile.TemporaryDirectory() as directory:
+        source = LocalStorage(os.path.join(directory, 'source'))
+        for index, payload in enumerate(payloads):
+            source.put('transcripts/{:08d}.json'.format(index), json.dumps(payload).encode('utf-8'))
+
+        def run(target):
+            metrics_path = os.path.join(directory, target + '-metrics.json')
+            start = time.perf_counter()
+            run_main(converter, ['--source', source.root,
+                                 '--target', os.path.join(directory, target),
+                                 '--concurrency', str(concurrency),
+                                 '--transform_processes', str(transform_processes),
+                                 '--json_codec', json_codec,
+                                 '--metrics_file', metrics_path] + output_arguments)
+            return time.perf_counter() - start
+
+        seconds = run('target')
+        return summarize(len(payloads), seconds, peak_memory=measure_peak_memory(lambda: run('target-memory')),
+                         stage_latencies=read_stage_latencies(os.path.join(directory, 'target-metrics.json')))
+
+
+def benchmark_stitch_pipeline(contact_lens_items, concurrency, json_codec, output_arguments):
+    with tempfile.TemporaryDirectory() as directory:
+        source, index_path, lex_log_index = build_stitch_fixture(directory, contact_lens_items)
+        lex_log_index.close()
+
+        metrics_path = os.path.join(directory, 'metrics.json')
+
+        def run():
+            start = time.perf_counter()
+            run_main(stitch_conversation_logs_and_contact_lens_transcripts,
+                     ['--source', source.root,
+                      '--lex_log_index', index_path,
+                      '--concurrency', str(concurrency),
+                      '--json_codec', json_codec,
+                      '--metrics_file', metrics_path] + output_arguments)
+            return time.perf_counter() - start
+
+        seconds = run()
+        stage_latencies = read_stage_latencies(metrics_path)
+        return summarize(len(contact_lens_items), seconds, peak_memory=measure_peak_memory(run),
+                         stage_latencies=stage_latencies)
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    regressions = 0
+    for name, result in results['benchmarks'].items():
+        baseline_result = baseline.get('benchmarks', {}).get(name)
+        if not baseline_result or not baseline_result.get('items_per_second') or not result.get('items_per_second'):
+            continue
+        ratio = result['items_per_second'] / baseline_result['items_per_second']
+        status = 'OK'
+        if ratio < 1 - tolerance:
+            status = 'REGRESSION'
+            regressions = regressions + 1
+        print('[BASELINE] {0}: {1:.2f} items/s vs {2:.2f} items/s ({3:+.1%}) {4}'.format(
+            name, result['items_per_second'], baseline_result['items_per_second'], ratio - 1, status))
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Benchmark the transcript converters and the stitcher against '
+                                                     'synthetic Amazon Connect Chat, Amazon Transcribe Call Analytics, '
+                                                     'Contact Lens and Amazon Lex Conversation Log payloads, using '
+                                                     'local storage and an offline conversation log index.')
+    arg_parser.add_argument('--benchmarks', required=False, nargs='+', choices=BENCHMARKS, default=BENCHMARKS,
+                            help="Benchmarks to run (default: all)")
+    arg_parser.add_argument('--items', required=False, type=int, default=1000,
+                            help="Number of synthetic transcripts per benchmark (default: %(default)s)")
+    arg_parser.add_argument('--turns', required=False, type=int, default=20,
+                            help="Number of turns per chat or Contact Lens transcript (default: %(default)s)")
+    arg_parser.add_argument('--call_turns', required=False, type=int, default=200,
+                            help="Number of segments per Call Analytics transcript (default: %(default)s)")
+    arg_parser.add_argument('--participants', required=False, type=int, default=2,
+                            help="Number of participants per transcript (default: %(default)s)")
+    arg_parser.add_argument('--lex_turns', required=False, type=int, default=4,
+                            help="Number of Amazon Lex Conversation Logs per contact (default: %(default)s)")
+    arg_parser.add_argument('--bot_messages', required=False, type=int, default=1,
+                            help="Number of bot messages per Amazon Lex Conversation Log (default: %(default)s)")
+    arg_parser.add_argument('--concurrency', required=False, type=int, default=10,
+                            help="Concurrency of the end-to-end pipeline benchmarks (default: %(default)s)")
+    arg_parser.add_argument('--transform_processes', required=False, type=int, default=0,
+                            help="Transform worker processes of the converter pipeline benchmarks (default: "
+                                 "%(default)s)")
+    arg_parser.add_argument('--json_codec', required=False, choices=JSON_CODECS, default=DEFAULT_JSON_CODEC,
+                            help="JSON codec of the end-to-end pipeline benchmarks (default: %(default)s)")
+    arg_parser.add_argument('--output_compression', required=False, choices=OUTPUT_COMPRESSIONS,
+                            default=DEFAULT_OUTPUT_COMPRESSION,
+                            help="Output compression of the end-to-end pipeline benchmarks (default: %(default)s)")
+    arg_parser.add_argument('--pack_size', required=False, type=int, default=0,
+                            help="Output pack size of the end-to-end pipeline benchmarks (default: %(default)s)")
+    arg_parser.add_argument('--seed', required=False, type=int, default=0,
+                            help="Seed of the synthetic payload generator (default: %(default)s)")
+    arg_parser.add_argument('--output', required=False, type=str, help="Write the results as JSON to this file")
+    arg_parser.add_argument('--baseline', required=False, type=str,
+                            help="Compare throughput against the results recorded in this JSON file")
+    arg_parser.add_argument('--tolerance', required=False, type=float, default=0.2,
+                            help="Allowed throughput drop against the baseline before it counts as a regression "
+                                 "(default: %(default)s)")
+
+    arg = arg_parser.parse_args()
+    rng = random.Random(arg.seed)
+    output_arguments = ['--output_compression', arg.output_compression, '--pack_size', str(arg.pack_size)]
+    results = {'parameters': {'items': arg.items,
+                              'turns': arg.turns,
+                              'call_turns': arg.call_turns,
+                              'participants': arg.participants,
+                              'lex_turns': arg.lex_turns,
+                              'bot_messages': arg.bot_messages,
+                              'concurrency': arg.concurrency,
+                              'transform_processes': arg.transform_processes,
+                              'json_codec': arg.json_codec,
+                              'output_compression': arg.output_compression,
+                              'pack_size': arg.pack_size,
+                              'seed': arg.seed,
+                              'python': sys.version.split()[0]},
+               'benchmarks': {}}
+
+    chat_payloads = [synthetic_transcripts.generate_connect_chat(rng, arg.turns, arg.participants)
+                     for _ in range(arg.items)] if any('connect_chat' in name for name in arg.benchmarks) else []
+    call_payloads = [synthetic_transcripts.generate_call_analytics(rng, arg.call_turns, arg.participants)
+                     for _ in range(arg.items)] if any('call_analytics' in name for name in arg.benchmarks) else []
+    contact_lens_items = [synthetic_transcripts.generate_contact_lens(rng, arg.turns, arg.lex_turns, arg.bot_messages)
+                          for _ in range(arg.items)] if any('stitch' in name for name in arg.benchmarks) else []
+
+    for name in arg.benchmarks:
+        if name == 'connect_chat_convert':
+            result = benchmark_convert(connect_chat_to_lex_transcripts, chat_payloads)
+        elif name == 'call_analytics_convert':
+            result = benchmark_convert(transcribe_call_analytics_to_lex_transcripts, call_payloads)
+        elif name == 'stitch':
+            result = benchmark_stitch(contact_lens_items)
+        elif name == 'connect_chat_pipeline':
+            result = benchmark_converter_pipeline(connect_chat_to_lex_transcripts, chat_payloads, arg.concurrency,
+                                                  arg.transform_processes, arg.json_codec, output_arguments)
+        elif name == 'call_analytics_pipeline':
+            result = benchmark_converter_pipeline(transcribe_call_analytics_to_lex_transcripts, call_payloads,
+                                                  arg.concurrency, arg.transform_processes, arg.json_codec,
+                                                  output_arguments)
+        else:
+            result = benchmark_stitch_pipeline(contact_lens_items, arg.concurrency, arg.json_codec, output_arguments)
+        results['benchmarks'][name] = result
+        print('[BENCHMARK] {0}: {1}'.format(name, json.dumps(result)))
+
+    if arg.output:
+        with open(arg.output, 'w', encoding='utf-8') as output_file:
+            json.dump(results, output_file, indent=2)
+
+    if arg.baseline:
+        with open(arg.baseline, 'r', encoding='utf-8') as baseline_file:
+            regressions = compare_to_baseline(results, json.load(baseline_file), arg.tolerance)
+        if regressions:
+            print('[COMPLETE] [{0}] benchmarks regressed against the baseline'.format(regressions))
+            return 1
+    print('[COMPLETE] Ran [{0}] benchmarks'.format(len(results['benchmarks'])))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,158 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import json
+import threading
+
+# Amazon Lex Conversation Logs are looked up within one hour either side of the Contact Lens conversation timestamp.
+CONTACT_WINDOW_MILLIS = 1 * 60 * 60 * 1000
+# Upper bound on the time range pulled from Amazon CloudWatch in one batch, which bounds the size of the index.
+MAX_BATCH_WINDOW_MILLIS = 6 * 60 * 60 * 1000
+# Only pull structured log events that carry a session ID, i.e. the Amazon Lex Conversation Logs themselves.
+CONVERSATION_LOG_FILTER_PATTERN = '{ $.sessionId = * }'
+
+
+def get_batch_windows(epoch_times,
+                      contact_window_millis=CONTACT_WINDOW_MILLIS,
+                      max_batch_window_millis=MAX_BATCH_WINDOW_MILLIS):
+    # Merge the look-up windows of contacts that overlap in time into as few [start, end) windows as possible.
+    windows = []
+    for epoch_time in sorted(epoch_times):
+        start = epoch_time - contact_window_millis
+        end = epoch_time + contact_window_millis + 1
+        if windows and start <= windows[-1][1] and end - windows[-1][0] <= max_batch_window_millis:
+            windows[-1][1] = max(windows[-1][1], end)
+        else:
+            windows.append([start, end])
+    return [tuple(window) for window in windows]
+
+
+def subtract_ranges(window, ranges):
+    # Return the parts of the [start, end) window that are not covered by any of the sorted [start, end) ranges.
+    start, end = window
+    uncovered = []
+    for range_start, range_end in ranges:
+        if range_end <= start or range_start >= end:
+            continue
+        if range_start > start:
+            uncovered.append((start, range_start))
+        start = max(start, range_end)
+        if start >= end:
+            break
+    if start < end:
+        uncovered.append((start, end))
+    return uncovered
+
+
+class CloudWatchLogWindowIndex:
+    # Pulls the Amazon Lex Conversation Logs of a whole time window with a single paginated filter_log_events scan,
+    # parses every event once and indexes it in memory by session ID. Contacts that overlap in time are then resolved
+    # from the index instead of scanning the same log events once per contact.
+    def __init__(self, cloudwatch_client, cloudwatch_log_group_name,
+                 contact_window_millis=CONTACT_WINDOW_MILLIS,
+                 max_batch_window_millis=MAX_BATCH_WINDOW_MILLIS):
+        self.cloudwatch_client = cloudwatch_client
+        self.cloudwatch_log_group_name = cloudwatch_log_group_name
+        self.contact_window_millis = contact_window_millis
+        self.max_batch_window_millis = max_batch_window_millis
+        self.api_calls = 0
+        self._lock = threading.Lock()
+        self._loaded_ranges = []
+        self._events_by_session = {}
+
+    def load(self, epoch_times, evict_before=None):
+        # Everything older than evict_before (by default, the earliest window needed for these contacts) is dropped.
+        # Callers that still have earlier contacts waiting for their look-up pass an earlier horizon.
+        windows = get_batch_windows(epoch_times, self.contact_window_millis, self.max_batch_window_millis)
+        if not windows:
+            return
+        with self._lock:
+            self._evict_before(windows[0][0] if evict_before is None else min(evict_before, windows[0][0]))
+        for window in windows:
+            with self._lock:
+                uncovered = subtract_ranges(window, self._loaded_ranges)
+            for start, end in uncovered:
+                events_by_session = self._fetch_window(start, end)
+                with self._lock:
+                    self._merge(events_by_session)
+                    self._loaded_ranges.append((start, end))
+                    self._loaded_ranges.sort()
+
+    def get_log_events(self, epoch_time, contact_id):
+        # Amazon Lex Conversation Logs use the Amazon Connect Contact ID as the Session ID.
+        start = epoch_time - self.contact_window_millis
+        end = epoch_time + self.contact_window_millis
+        with self._lock:
+            lex_logs = [event for event in self._events_by_session.get(contact_id, [])
+                        if start <= event[0] <= end]
+        found_match = len(lex_logs) > 0
+
+        if not found_match:
+            print('[IN PROGRESS] Did not find any matching Amazon Lex Conversation Logs for contact ID ' + contact_id)
+
+        return lex_logs, found_match
+
+    def _fetch_window(self, start, end):
+        next_token = None
+        more_results = True
+        events_by_session = {}
+
+        while more_results:
+            filter_arguments = {'logGroupName': self.cloudwatch_log_group_name,
+                                'startTime': start,
+                                'endTime': end - 1,
+                                'filterPattern': CONVERSATION_LOG_FILTER_PATTERN}
+            if next_token:
+                filter_arguments['nextToken'] = next_token
+            response = self.cloudwatch_client.filter_log_events(**filter_arguments)
+            self.api_calls = self.api_calls + 1
+
+            for event in response.get('events'):
+                message = event.get('message')
+                try:
+                    session_id = json.loads(message).get('sessionId')
+                except (ValueError, AttributeError):
+                    continue
+                if session_id:
+                    events_by_session.setdefault(session_id, []).append((event.get('timestamp'), message))
+
+            # If there are more results, continue pagination.
+            if response.get('nextToken') is None:
+                more_results = False
+            else:
+                next_token = response.get('nextToken')
+
+        return events_by_session
+
+    def _merge(self, events_by_session):
+        # Events are returned in time order per log stream, so keep every session's events ordered across streams.
+        for session_id, events in events_by_session.items():
+            session_events = self._events_by_session.setdefault(session_id, [])
+            session_events.extend(events)
+            session_events.sort(key=lambda event: event[0])
+
+    def _evict_before(self, epoch_time):
+        # Drop whatever no pending contact can match any more, so memory stays bounded over a long run.
+        self._loaded_ranges = [(max(range_start, epoch_time), range_end)
+                               for range_start, range_end in self._loaded_ranges if range_end > epoch_time]
+        for session_id in list(self._events_by_session):
+            events = [event for event in self._events_by_session[session_id] if event[0] >= epoch_time]
+            if events:
+                self._events_by_session[session_id] = events
+            else:
+                del self._events_by_session[session_id]
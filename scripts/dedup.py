@@ -0,0 +1,78 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import hashlib
+import threading
+
+FINGERPRINT_BYTES = 16
+# Only this many bytes of every fingerprint are kept in memory. At 64 bits a collision among a hundred million
+# transcripts is still a one in several thousand chance, and the seen-set stays a set of small integers.
+SEEN_FINGERPRINT_BYTES = 8
+
+
+def normalize_content(content):
+    # Whitespace and letter case differences between exports of the same conversation are not real differences.
+    return ' '.join((content or '').split()).casefold()
+
+
+def get_transcript_fingerprint(contact_lens_json):
+    # Fingerprint what was said and by whom, in order. IDs, contact IDs and timestamps are left out, since exports of
+    # the same conversation (and the Amazon Transcribe converter) assign them differently every time.
+    participant_roles = dict()
+    for participant in contact_lens_json.get('Participants', []):
+        participant_roles[participant.get('ParticipantId')] = participant.get('ParticipantRole')
+    digest = hashlib.blake2b(digest_size=FINGERPRINT_BYTES)
+    for transcript in contact_lens_json.get('Transcript', []):
+        digest.update(str(participant_roles.get(transcript.get('ParticipantId'))).encode('utf-8'))
+        digest.update(b'\x1f')
+        digest.update(normalize_content(transcript.get('Content')).encode('utf-8'))
+        digest.update(b'\x1e')
+    return digest.hexdigest()
+
+
+class ContentDeduplicator:
+    # A seen-set of transcript fingerprints. A transcript is claimed before it is uploaded, so of several copies in
+    # flight at once only the first is written; a failed upload releases its claim again. With a manifest, the
+    # fingerprints it recorded in earlier runs are loaded as well, so duplicates of transcripts written by those runs
+    # are skipped too.
+    def __init__(self, manifest=None):
+        self._lock = threading.Lock()
+        self._seen = set()
+        self.duplicate_keys = 0
+        if manifest is not None:
+            for record in manifest.processed.values():
+                if record.get('fingerprint'):
+                    self._seen.add(self._get_seen_key(record['fingerprint']))
+
+    @staticmethod
+    def _get_seen_key(fingerprint):
+        return int(fingerprint[:SEEN_FINGERPRINT_BYTES * 2], 16)
+
+    def claim(self, fingerprint):
+        # Return True when the fingerprint was not seen before, and mark it as seen.
+        seen_key = self._get_seen_key(fingerprint)
+        with self._lock:
+            if seen_key in self._seen:
+                self.duplicate_keys = self.duplicate_keys + 1
+                return False
+            self._seen.add(seen_key)
+            return True
+
+    def release(self, fingerprint):
+        with self._lock:
+            self._seen.discard(self._get_seen_key(fingerprint))
@@ -0,0 +1,209 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import argparse
+import json
+import os
+import sys
+import urllib.parse
+
+# Only the standard library is imported up front. The AWS SDK and the converter or stitcher module are imported the
+# first time an event needs them, and the clients are kept for later invocations of a warm runtime.
+TRANSCRIPT_FORMATS = ['connect_chat', 'call_analytics', 'contact_lens']
+CONTACT_LENS_PREFIX = 'Analysis/'
+STITCHED_PREFIX = 'AnalysisWithLexLogs/'
+
+_clients = dict()
+_modules = dict()
+
+
+def get_client(service_name):
+    if service_name not in _clients:
+        import boto3
+
+        _clients[service_name] = boto3.client(service_name)
+    return _clients[service_name]
+
+
+def get_module(transcript_format):
+    if transcript_format not in _modules:
+        if transcript_format == 'connect_chat':
+            import connect_chat_to_lex_transcripts as module
+        elif transcript_format == 'call_analytics':
+            import transcribe_call_analytics_to_lex_transcripts as module
+        else:
+            import stitch_conversation_logs_and_contact_lens_transcripts as module
+        _modules[transcript_format] = module
+    return _modules[transcript_format]
+
+
+def get_config(environment=None):
+    # Configuration comes from environment variables, the way an AWS Lambda function is configured.
+    environment = os.environ if environment is None else environment
+    config = {'transcript_format': environment.get('TRANSCRIPT_FORMAT'),
+              'target': environment.get('TARGET'),
+              'cloudwatch_log_group_name': environment.get('CLOUDWATCH_LOG_GROUP_NAME'),
+              'json_codec': environment.get('JSON_CODEC', 'json'),
+              'output_compression': environment.get('OUTPUT_COMPRESSION', 'none')}
+    if config['transcript_format'] not in TRANSCRIPT_FORMATS:
+        raise ValueError('TRANSCRIPT_FORMAT must be one of {0}'.format(TRANSCRIPT_FORMATS))
+    if config['transcript_format'] == 'contact_lens' and not config['cloudwatch_log_group_name']:
+        raise ValueError('CLOUDWATCH_LOG_GROUP_NAME is required to stitch Contact Lens transcripts')
+    if config['transcript_format'] != 'contact_lens' and not config['target']:
+        raise ValueError('TARGET is required to convert transcripts')
+    return config
+
+
+def get_created_objects(event):
+    # Yield (message ID, bucket, S3 object) for every created object in an Amazon S3 event notification, whether it
+    # was delivered directly, through Amazon SQS or Amazon SNS (or both), or as an Amazon EventBridge event. The
+    # message ID is only set for Amazon SQS messages, so their failures can be reported one by one. Anything that is
+    # not an Amazon S3 event is yielded with no bucket and object, so it fails instead of being dropped.
+    if event.get('detail-type') == 'Object Created':
+        detail = event.get('detail', {})
+        yield None, detail['bucket']['name'], {'Key': detail['object']['key'], 'ETag': detail['object'].get('etag')}
+        return
+    if event.get('source') == 'aws.s3' or event.get('Event') == 's3:TestEvent':
+        # Other Amazon EventBridge events of the bucket, such as deletions, and the test message Amazon S3 sends
+        # when a notification is set up.
+        return
+    if event.get('Type') == 'Notification':
+        # An Amazon SNS message delivered to Amazon SQS keeps its envelope, with the Amazon S3 event as its message.
+        yield from get_created_objects(json.loads(event['Message']))
+        return
+    if 'Records' not in event:
+        yield None, None, None
+        return
+
+    for record in event['Records']:
+        if record.get('eventSource') == 'aws:sqs':
+            try:
+                body = json.loads(record['body'])
+            except ValueError:
+                body = dict()
+            for _, bucket, s3_object in get_created_objects(body):
+                yield record.get('messageId'), bucket, s3_object
+        elif record.get('EventSource') == 'aws:sns':
+            for _, bucket, s3_object in get_created_objects(json.loads(record['Sns']['Message'])):
+                yield None, bucket, s3_object
+        elif record.get('eventSource') == 'aws:s3':
+            if record.get('eventName', '').startswith('ObjectCreated'):
+                s3_record = record['s3']
+                # Keys in Amazon S3 event notifications are URL encoded.
+                yield None, s3_record['bucket']['name'], {'Key': urllib.parse.unquote_plus(s3_record['object']['key']),
+                                                          'ETag': s3_record['object'].get('eTag')}
+        else:
+            yield None, None, None
+
+
+def get_stitched_key(key):
+    # Mirror the batch stitcher: <prefix>Analysis/... is written to <prefix>AnalysisWithLexLogs/Analysis/...
+    index = key.find(CONTACT_LENS_PREFIX)
+    while index > 0 and key[index - 1] != '/':
+        index = key.find(CONTACT_LENS_PREFIX, index + 1)
+    if index < 0:
+        return None
+    return key[:index] + STITCHED_PREFIX + key[index:]
+
+
+def process_object(config, bucket, s3_object):
+    from json_codec import get_json_codec
+    from output_sink import ObjectOutputSink
+    from storage import S3Storage, get_storage
+
+    key = s3_object.get('Key')
+    transcript_format = config['transcript_format']
+    source_storage = S3Storage(get_client('s3'), bucket)
+    module = get_module(transcript_format)
+
+    if transcript_format == 'contact_lens':
+        stitched_key = get_stitched_key(key)
+        # Stitched output lands in the same bucket, so ignore it rather than stitching it again.
+        if not key.endswith('.json') or stitched_key is None or STITCHED_PREFIX in key:
+            return None
+        stitched_json, found_match = module.stitch_conversation_logs(source_storage.get(key),
+                                                                     key,
+                                                                     config['cloudwatch_log_group_name'],
+                                                                     get_client('logs'))
+        output_sink = ObjectOutputSink(source_storage, '', config['output_compression'])
+        output_sink.write(s3_object, stitched_key, get_json_codec(config['json_codec']).dumps(stitched_json))
+        return stitched_key
+
+    if not key.endswith('.json'):
+        return None
+    target_storage, target_prefix = get_storage(config['target'], s3_client=get_client('s3'))
+    file_name, contact_lens_body, _, _, _ = module.transform_transcript(s3_object, source_storage.get(key),
+                                                                         config['json_codec'])
+    output_sink = ObjectOutputSink(target_storage, target_prefix, config['output_compression'])
+    output_sink.write(s3_object, file_name, contact_lens_body)
+    return target_prefix + file_name
+
+
+def handler(event, context=None):
+    # Entry point for AWS Lambda. Every created object is converted or stitched as soon as it lands. When the
+    # notifications come through Amazon SQS, failed messages are reported individually so only they are retried;
+    # otherwise any failure fails the invocation, so it is retried as a whole.
+    config = get_config()
+    processed_keys = 0
+    failed_message_ids = []
+    failed_keys = []
+    unrecognized_records = 0
+    for message_id, bucket, s3_object in get_created_objects(event):
+        if s3_object is None:
+            print('[ERROR] Failed to find an Amazon S3 event in message [{0}]'.format(message_id))
+            unrecognized_records = unrecognized_records + 1
+            if message_id is not None and message_id not in failed_message_ids:
+                failed_message_ids.append(message_id)
+            continue
+        try:
+            output_key = process_object(config, bucket, s3_object)
+        except Exception as error:
+            print('[ERROR] Failed to process key [{0}]: {1}'.format(s3_object.get('Key'), error))
+            failed_keys.append(s3_object.get('Key'))
+            if message_id is not None and message_id not in failed_message_ids:
+                failed_message_ids.append(message_id)
+            continue
+        if output_key is None:
+            print('[IN PROGRESS] Skipped key [{0}]'.format(s3_object.get('Key')))
+        else:
+            processed_keys = processed_keys + 1
+            print('[IN PROGRESS] Wrote [{0}] for key [{1}]'.format(output_key, s3_object.get('Key')))
+
+    if failed_message_ids:
+        return {'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failed_message_ids]}
+    if failed_keys:
+        raise RuntimeError('Failed to process keys {0}'.format(failed_keys))
+    if unrecognized_records:
+        raise RuntimeError('Failed to find an Amazon S3 event in [{0}] records'.format(unrecognized_records))
+    return {'processedKeys': processed_keys}
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Run the event handler locally against an Amazon S3 event '
+                                                     'notification saved as JSON. It is configured through the same '
+                                                     'environment variables as the AWS Lambda function.')
+    arg_parser.add_argument('--event', required=True, type=str, help="Path of the JSON event to process")
+
+    arg = arg_parser.parse_args()
+    with open(arg.event, 'r', encoding='utf-8') as event_file:
+        event = json.load(event_file)
+    print('[COMPLETE] {0}'.format(json.dumps(handler(event))))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,66 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import json
+
+JSON_CODECS = ['json', 'orjson']
+DEFAULT_JSON_CODEC = 'json'
+
+
+class StdlibJsonCodec:
+    # Takes the downloaded bytes and returns the bytes to upload, like orjson. The standard library only works on str
+    # though, so both directions still make a temporary str copy of the whole document.
+    name = 'json'
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+    @staticmethod
+    def dumps(json_data):
+        return json.dumps(json_data).encode('utf-8')
+
+
+class OrjsonCodec:
+    # orjson parses and serializes several times faster than the standard library and works on bytes natively. Its
+    # output is equivalent JSON, but non-ASCII characters are written as UTF-8 rather than as \u escapes.
+    name = 'orjson'
+
+    def __init__(self):
+        import orjson
+
+        self.loads = orjson.loads
+        self.dumps = orjson.dumps
+
+
+_codecs = {}
+
+
+def get_json_codec(name=DEFAULT_JSON_CODEC):
+    # Codecs are looked up by name, so worker processes can be told which one to use without pickling it.
+    if name not in _codecs:
+        if name == 'json':
+            _codecs[name] = StdlibJsonCodec()
+        elif name == 'orjson':
+            try:
+                _codecs[name] = OrjsonCodec()
+            except ImportError:
+                raise ValueError('The orjson JSON codec requires the orjson package (pip install orjson)')
+        else:
+            raise ValueError('Unknown JSON codec [{0}], expected one of {1}'.format(name, JSON_CODECS))
+    return _codecs[name]
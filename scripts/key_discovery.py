@@ -0,0 +1,327 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import csv
+import datetime
+import gzip
+import heapq
+import io
+import json
+import os
+import pickle
+import queue
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+from storage import PAGE_SIZE, S3_URI_PREFIX, LocalStorage, S3Storage, get_storage
+
+LISTING_SPLITS = ['prefix', 'character']
+DEFAULT_LISTING_SPLIT = 'prefix'
+DEFAULT_LISTING_DEPTH = 3
+# Boundaries of the character ranges, in the byte order Amazon S3 lists keys in. They cover contact IDs, dates and
+# most generated file names.
+RANGE_BOUNDARY_CHARACTERS = '0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+# How many listed pages each range may run ahead of the one being consumed.
+BUFFERED_PAGES = 2
+QUEUE_TIMEOUT_SECONDS = 0.5
+DEFAULT_INVENTORY_SCHEMA = 'Bucket, Key, Size, LastModifiedDate, ETag'
+
+
+def get_key_source(storage, inventory=None, listing_concurrency=1, listing_split=DEFAULT_LISTING_SPLIT,
+                   listing_depth=DEFAULT_LISTING_DEPTH, access_key=None, secret_key=None, region=None, api_guard=None,
+                   metrics=None):
+    # Return what the keys to process are listed from. Every key source lists pages like the storage backends do,
+    # in the same lexicographic key order, so manifest checkpoints keep working whichever one is used.
+    if inventory:
+        return InventoryListing(inventory, access_key, secret_key, region, api_guard, metrics)
+    if listing_concurrency > 1:
+        return ShardedListing(storage, listing_concurrency, listing_split, listing_depth)
+    return storage
+
+
+def is_before(prefix, start_after):
+    # True when every key under the prefix sorts at or before start_after, so the prefix can be skipped entirely.
+    return start_after is not None and start_after >= prefix and not start_after.startswith(prefix)
+
+
+class _KeyRange:
+    # Keys under a prefix that sort after start_after and, if set, at or before last_key.
+    def __init__(self, prefix, start_after=None, last_key=None):
+        self.prefix = prefix
+        self.start_after = start_after
+        self.last_key = last_key
+
+    def list_pages(self, storage):
+        for page in storage.list_pages(prefix=self.prefix, start_after=self.start_after):
+            if self.last_key is not None and page and page[-1].get('Key') > self.last_key:
+                yield [listed_object for listed_object in page if listed_object.get('Key') <= self.last_key]
+                return
+            yield page
+
+
+class _ListedObjects:
+    # Objects that were already listed while the prefixes were being discovered.
+    def __init__(self, listed_objects):
+        self.listed_objects = listed_objects
+
+    def list_pages(self, storage):
+        yield self.listed_objects
+
+
+class ShardedListing:
+    # Splits the listing of a prefix into disjoint key ranges and lists up to `concurrency` of them in parallel.
+    # Ranges are either the '/'-separated sub-prefixes found listing_depth levels down (e.g. the year, month and day
+    # of Contact Lens keys), or one range per leading character after the prefix, for flat key spaces. The ranges
+    # are consumed in key order and their pages re-batched, so the result is identical to a sequential listing.
+    def __init__(self, storage, concurrency, split=DEFAULT_LISTING_SPLIT, depth=DEFAULT_LISTING_DEPTH):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        if split not in LISTING_SPLITS:
+            raise ValueError('Unknown listing split [{0}], expected one of {1}'.format(split, LISTING_SPLITS))
+        self.storage = storage
+        self.concurrency = concurrency
+        self.split = split
+        self.depth = depth
+
+    def list_pages(self, prefix=None, start_after=None):
+        prefix = prefix or ''
+        executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='listing')
+        stopped = threading.Event()
+        try:
+            if self.split == 'prefix':
+                key_ranges = self._discover_prefixes(executor, prefix, start_after)
+            else:
+                key_ranges = self._get_character_ranges(prefix, start_after)
+
+            # Every range gets its own small queue. Ranges are submitted in key order, so the one being consumed has
+            # always been picked up by a worker, while the following ones run ahead until their queue is full.
+            page_queues = []
+            for key_range in key_ranges:
+                page_queue = queue.Queue(maxsize=BUFFERED_PAGES)
+                page_queues.append(page_queue)
+                executor.submit(self._list_range, key_range, page_queue, stopped)
+
+            batch = []
+            for page_queue in page_queues:
+                while True:
+                    page = page_queue.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        raise page
+                    batch.extend(page)
+                    # Hand pages on at the usual size, however small the individual ranges are.
+                    while len(batch) >= PAGE_SIZE:
+                        yield batch[:PAGE_SIZE]
+                        batch = batch[PAGE_SIZE:]
+            if batch:
+                yield batch
+        finally:
+            stopped.set()
+            executor.shutdown(wait=True)
+
+    def _list_range(self, key_range, page_queue, stopped):
+        try:
+            for page in key_range.list_pages(self.storage):
+                if not self._put(page_queue, page, stopped):
+                    return
+        except Exception as error:
+            self._put(page_queue, error, stopped)
+            return
+        self._put(page_queue, None, stopped)
+
+    @staticmethod
+    def _put(page_queue, page, stopped):
+        # Give up once the consumer has stopped, instead of blocking on a queue nobody reads any more.
+        while not stopped.is_set():
+            try:
+                page_queue.put(page, timeout=QUEUE_TIMEOUT_SECONDS)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _discover_prefixes(self, executor, prefix, start_after):
+        # Walk down the '/'-separated levels below the prefix, listing each level's prefixes in parallel.
+        units = [(prefix, None)]
+        for _ in range(self.depth):
+            prefixes = [unit_prefix for unit_prefix, listed_object in units if listed_object is None]
+            if not prefixes:
+                break
+            levels = dict(zip(prefixes, executor.map(self.storage.list_prefixes, prefixes)))
+            expanded_units = []
+            for unit_prefix, listed_object in units:
+                if listed_object is not None:
+                    expanded_units.append((unit_prefix, listed_object))
+                    continue
+                listed_objects, sub_prefixes = levels[unit_prefix]
+                expanded_units.extend((listed_object.get('Key'), listed_object) for listed_object in listed_objects
+                                      if start_after is None or listed_object.get('Key') > start_after)
+                expanded_units.extend((sub_prefix, None) for sub_prefix in sub_prefixes
+                                      if not is_before(sub_prefix, start_after))
+            # Keys under a prefix are contiguous in key order, so sorting objects and prefixes by name keeps the
+            # overall listing order.
+            units = sorted(expanded_units, key=lambda unit: unit[0])
+
+        key_ranges = []
+        for unit_prefix, listed_object in units:
+            if listed_object is None:
+                key_ranges.append(_KeyRange(unit_prefix,
+                                            start_after if start_after and start_after.startswith(unit_prefix)
+                                            else None))
+            elif key_ranges and isinstance(key_ranges[-1], _ListedObjects):
+                key_ranges[-1].listed_objects.append(listed_object)
+            else:
+                key_ranges.append(_ListedObjects([listed_object]))
+        return key_ranges
+
+    @staticmethod
+    def _get_character_ranges(prefix, start_after):
+        # Range i holds the keys after boundary i - 1, up to and including boundary i. Boundaries are the prefix
+        # followed by a single character, so together the ranges cover every key under the prefix exactly once.
+        boundaries = [prefix + character for character in RANGE_BOUNDARY_CHARACTERS]
+        key_ranges = []
+        lower_bound = start_after
+        for boundary in boundaries + [None]:
+            if boundary is not None and start_after is not None and boundary <= start_after:
+                continue
+            key_ranges.append(_KeyRange(prefix, lower_bound, boundary))
+            lower_bound = boundary
+        return key_ranges
+
+
+def parse_inventory_time(last_modified):
+    if last_modified is None or isinstance(last_modified, datetime.datetime):
+        return last_modified
+    return datetime.datetime.fromisoformat(last_modified.replace('Z', '+00:00'))
+
+
+class InventoryListing:
+    # Lists keys from an Amazon S3 Inventory report instead of the live bucket, which saves millions of ListObjects
+    # calls on large buckets. The location is the manifest.json of a report, either in Amazon S3 or a local copy of
+    # the report that keeps its layout (the data/ directory next to the dated directory of the manifest). CSV reports
+    # are read directly; Parquet reports require pyarrow. The report is only as fresh as its last delivery, so keys
+    # written since then are not seen.
+    def __init__(self, location, access_key=None, secret_key=None, region=None, api_guard=None, metrics=None):
+        if location.startswith(S3_URI_PREFIX):
+            storage, manifest_key = get_storage(location, access_key, secret_key, region, api_guard=api_guard)
+            if metrics is not None:
+                metrics.instrument_client(storage.s3_client)
+            self.manifest = json.loads(storage.get(manifest_key))
+            destination_bucket = self.manifest['destinationBucket'].split(':::')[-1]
+            self._data_storage = S3Storage(storage.s3_client, destination_bucket)
+            self._local_data_directory = None
+        else:
+            with open(location, 'r', encoding='utf-8') as manifest_file:
+                self.manifest = json.load(manifest_file)
+            self._data_storage = None
+            self._local_data_directory = os.path.join(os.path.dirname(os.path.abspath(location)), os.pardir, 'data')
+
+        self.file_format = self.manifest.get('fileFormat', 'CSV')
+        if self.file_format not in ('CSV', 'Parquet'):
+            raise ValueError('Amazon S3 Inventory reports in [{0}] format are not supported, use CSV or '
+                             'Parquet'.format(self.file_format))
+        if self.file_format == 'Parquet':
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ValueError('Amazon S3 Inventory reports in Parquet format require the pyarrow package '
+                                 '(pip install pyarrow)')
+        self.columns = [column.strip() for column in self.manifest.get('fileSchema',
+                                                                        DEFAULT_INVENTORY_SCHEMA).split(',')]
+
+    def _read_data_file(self, key):
+        if self._data_storage is not None:
+            return self._data_storage.get(key)
+        return LocalStorage(self._local_data_directory).get(key.rpartition('/')[2])
+
+    def _read_rows(self, body):
+        # Yield (key, size, ETag, last modified) for every current object version in one data file.
+        if self.file_format == 'Parquet':
+            import pyarrow.parquet
+
+            table = pyarrow.parquet.read_table(io.BytesIO(body))
+            for row in table.to_pylist():
+                if row.get('is_latest') is False or row.get('is_delete_marker') is True:
+                    continue
+                yield row.get('key'), row.get('size'), row.get('e_tag'), row.get('last_modified_date')
+            return
+
+        for values in csv.reader(io.TextIOWrapper(gzip.GzipFile(fileobj=io.BytesIO(body)), encoding='utf-8')):
+            row = dict(zip(self.columns, values))
+            if row.get('IsLatest') == 'false' or row.get('IsDeleteMarker') == 'true':
+                continue
+            # Keys are URL encoded in CSV reports.
+            size = row.get('Size')
+            yield (urllib.parse.unquote_plus(row.get('Key')), int(size) if size else None, row.get('ETag'),
+                   row.get('LastModifiedDate'))
+
+    def _write_sorted_run(self, data_key, directory, prefix, start_after):
+        # Sort the matching rows of one data file and spill them to a local run file, so only one data file is held in
+        # memory at a time.
+        rows = []
+        for row in self._read_rows(self._read_data_file(data_key)):
+            key = row[0]
+            if prefix and not key.startswith(prefix):
+                continue
+            if start_after and key <= start_after:
+                continue
+            rows.append(row)
+        rows.sort(key=lambda row: row[0])
+
+        run_file = tempfile.TemporaryFile(dir=directory)
+        for row in rows:
+            pickle.dump(row, run_file, pickle.HIGHEST_PROTOCOL)
+        run_file.seek(0)
+        return run_file
+
+    @staticmethod
+    def _read_sorted_run(run_file):
+        while True:
+            try:
+                yield pickle.load(run_file)
+            except EOFError:
+                return
+
+    def list_pages(self, prefix=None, start_after=None):
+        # Data files are not ordered by key, so each one is sorted into a run file on local disk and the runs are
+        # merged. Memory is bounded by the largest data file rather than by the report.
+        with tempfile.TemporaryDirectory(prefix='inventory-') as directory:
+            run_files = []
+            try:
+                for data_file in self.manifest.get('files', []):
+                    run_files.append(self._write_sorted_run(data_file['key'], directory, prefix, start_after))
+
+                page = []
+                runs = [self._read_sorted_run(run_file) for run_file in run_files]
+                for key, size, etag, last_modified in heapq.merge(*runs, key=lambda row: row[0]):
+                    # Describe the objects the way ListObjects does, including the quotes around the ETag.
+                    page.append({'Key': key,
+                                 'Size': size,
+                                 'ETag': '"{}"'.format(etag) if etag else None,
+                                 'LastModified': parse_inventory_time(last_modified)})
+                    if len(page) == PAGE_SIZE:
+                        yield page
+                        page = []
+                if page:
+                    yield page
+            finally:
+                for run_file in run_files:
+                    run_file.close()
@@ -0,0 +1,178 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import argparse
+import datetime
+import hashlib
+import re
+
+from sharding import get_shard
+
+# Relative times such as 30d, 12h or 90m count back from when the run starts.
+RELATIVE_TIME_PATTERN = re.compile(r'^(\d+)([dhm])$')
+RELATIVE_TIME_UNITS = {'d': 'days', 'h': 'hours', 'm': 'minutes'}
+# Conversation timestamps in key names: Contact Lens (<contact ID>_analysis_2021-05-03T18:21:23Z.json), the Amazon
+# Transcribe converter's output (<ID>_analysis_2021-05-03_T18:21:23Z.json) and Amazon Connect Chat
+# (<contact ID>_20210503T18:21_UTC.json).
+KEY_TIME_PATTERNS = [(re.compile(r'_analysis_(\d{4}-\d{2}-\d{2})_?T(\d{2}:\d{2}:\d{2})Z\.json$'), '%Y-%m-%d %H:%M:%S'),
+                     (re.compile(r'_(\d{8})T(\d{2}:\d{2})_UTC\.json$'), '%Y%m%d %H:%M')]
+SAMPLE_HASH_BYTES = 8
+
+
+def parse_time(value, now=None):
+    # An ISO 8601 date or time (UTC unless it says otherwise), or a time relative to now.
+    match = RELATIVE_TIME_PATTERN.match(value)
+    if match:
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        return now - datetime.timedelta(**{RELATIVE_TIME_UNITS[match.group(2)]: int(match.group(1))})
+    try:
+        utc_time = datetime.datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError('Invalid time [{0}], expected an ISO 8601 date or time, or a relative time such as 30d, '
+                         '12h or 90m'.format(value))
+    if utc_time.tzinfo is None:
+        utc_time = utc_time.replace(tzinfo=datetime.timezone.utc)
+    return utc_time
+
+
+def parse_sample_rate(value):
+    try:
+        sample_rate = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid sample rate [{0}], expected a number'.format(value))
+    if not 0 <= sample_rate <= 1:
+        raise argparse.ArgumentTypeError('invalid sample rate [{0}], expected a fraction between 0 and 1'.format(value))
+    return sample_rate
+
+
+def get_key_time(key):
+    # The conversation time embedded in a transcript key, or None when the key does not carry one.
+    for pattern, time_format in KEY_TIME_PATTERNS:
+        match = pattern.search(key)
+        if match:
+            utc_time = datetime.datetime.strptime(' '.join(match.groups()), time_format)
+            return utc_time.replace(tzinfo=datetime.timezone.utc)
+    return None
+
+
+def get_sample_point(key, seed=''):
+    # A stable point in [0, 1) for every key. A key is in a sample of rate r when its point is below r, so the same
+    # keys are picked on every run, and with the same seed a larger sample contains every smaller one.
+    digest = hashlib.blake2b((seed + '\0' + key).encode('utf-8'), digest_size=SAMPLE_HASH_BYTES).digest()
+    return int.from_bytes(digest, 'big') / float(1 << (8 * SAMPLE_HASH_BYTES))
+
+
+class KeyFilter:
+    # Selects listed objects by their listing metadata and key name alone, before anything is downloaded. Ranges are
+    # inclusive at the start and exclusive at the end. Objects the listing did not give a size or last-modified time
+    # for, and keys without a conversation timestamp, do not match a filter on that field. When the work is split
+    # across several nodes, only the keys of one shard are kept.
+    def __init__(self, modified_after=None, modified_before=None, conversation_after=None, conversation_before=None,
+                 min_size=None, max_size=None, sample_rate=None, sample_seed='', shard_index=0, shard_count=1):
+        if sample_rate is not None and not 0 <= sample_rate <= 1:
+            raise ValueError('sample_rate must be between 0 and 1')
+        if shard_count < 1 or not 0 <= shard_index < shard_count:
+            raise ValueError('shard_index must be between 0 and shard_count - 1')
+        self.modified_after = modified_after
+        self.modified_before = modified_before
+        self.conversation_after = conversation_after
+        self.conversation_before = conversation_before
+        self.min_size = min_size
+        self.max_size = max_size
+        self.sample_rate = sample_rate
+        self.sample_seed = sample_seed
+        self.shard_index = shard_index
+        self.shard_count = shard_count
+        self.filtered_keys = 0
+
+    def is_active(self):
+        if self.shard_count > 1:
+            return True
+        return any(value is not None for value in (self.modified_after, self.modified_before, self.conversation_after,
+                                                   self.conversation_before, self.min_size, self.max_size,
+                                                   self.sample_rate))
+
+    def matches(self, s3_object):
+        if self.modified_after is not None or self.modified_before is not None:
+            if not self._in_range(s3_object.get('LastModified'), self.modified_after, self.modified_before):
+                return False
+        if self.conversation_after is not None or self.conversation_before is not None:
+            if not self._in_range(get_key_time(s3_object.get('Key')), self.conversation_after,
+                                  self.conversation_before):
+                return False
+        if self.min_size is not None or self.max_size is not None:
+            size = s3_object.get('Size')
+            if size is None:
+                return False
+            if self.min_size is not None and size < self.min_size:
+                return False
+            if self.max_size is not None and size > self.max_size:
+                return False
+        if self.shard_count > 1 and get_shard(s3_object.get('Key'), self.shard_count) != self.shard_index:
+            return False
+        if self.sample_rate is not None:
+            return get_sample_point(s3_object.get('Key'), self.sample_seed) < self.sample_rate
+        return True
+
+    @staticmethod
+    def _in_range(value, start, end):
+        if value is None:
+            return False
+        if start is not None and value < start:
+            return False
+        if end is not None and value >= end:
+            return False
+        return True
+
+    def filter_pages(self, pages):
+        # Drop every object outside the selection. Pages are kept, even when empty, so checkpoints still follow them.
+        for page in pages:
+            selected = [s3_object for s3_object in page if self.matches(s3_object)]
+            self.filtered_keys = self.filtered_keys + len(page) - len(selected)
+            yield selected
+
+
+def add_key_filter_arguments(arg_parser):
+    # The selection flags every script that lists a source bucket accepts. The shard flags are added by the scripts,
+    # which also use them to name their per-shard files.
+    arg_parser.add_argument('--modified_after', required=False, type=parse_time,
+                            help="Only process objects last modified at or after this ISO 8601 date or time (UTC "
+                                 "unless given), or this long ago, such as 30d, 12h or 90m")
+    arg_parser.add_argument('--modified_before', required=False, type=parse_time,
+                            help="Only process objects last modified before this time, in the same formats")
+    arg_parser.add_argument('--conversation_after', required=False, type=parse_time,
+                            help="Only process keys whose file name carries a conversation time at or after this time, "
+                                 "in the same formats")
+    arg_parser.add_argument('--conversation_before', required=False, type=parse_time,
+                            help="Only process keys whose file name carries a conversation time before this time, in "
+                                 "the same formats")
+    arg_parser.add_argument('--min_size', required=False, type=int,
+                            help="Only process objects of at least this many bytes")
+    arg_parser.add_argument('--max_size', required=False, type=int,
+                            help="Only process objects of at most this many bytes")
+    arg_parser.add_argument('--sample_rate', required=False, type=parse_sample_rate,
+                            help="Only process this fraction (0 to 1) of the keys, picked by a hash of the key so the "
+                                 "same keys are picked on every run")
+    arg_parser.add_argument('--sample_seed', required=False, type=str, default='',
+                            help="Pick a different, equally stable sample of keys")
+
+
+def get_key_filter(arg):
+    # The KeyFilter for the flags of add_key_filter_arguments and the --shard_index and --shard_count flags.
+    return KeyFilter(arg.modified_after, arg.modified_before, arg.conversation_after, arg.conversation_before,
+                     arg.min_size, arg.max_size, arg.sample_rate, arg.sample_seed, arg.shard_index, arg.shard_count)
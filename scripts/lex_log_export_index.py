@@ -0,0 +1,148 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import datetime
+import gzip
+import json
+import sqlite3
+import threading
+
+from cloudwatch_log_index import CONTACT_WINDOW_MILLIS
+
+GZIP_MAGIC = b'\x1f\x8b'
+INSERT_BATCH_SIZE = 10000
+
+
+def parse_timestamp(timestamp):
+    # Timestamps are either epoch milliseconds or ISO 8601 strings such as 2021-05-03T18:21:23.123Z.
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    utc_time = datetime.datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    if utc_time.tzinfo is None:
+        utc_time = utc_time.replace(tzinfo=datetime.timezone.utc)
+    return int(utc_time.timestamp() * 1000)
+
+
+def parse_export_line(line):
+    # An Amazon CloudWatch Logs export writes one event per line as "<ISO 8601 timestamp> <message>". Lines holding
+    # a JSON event ({"timestamp": ..., "message": ...}) or the bare conversation log are accepted as well.
+    line = line.strip()
+    if not line:
+        return None
+    if line.startswith('{'):
+        record = json.loads(line)
+        if 'message' in record and 'timestamp' in record:
+            message = record['message']
+            lex_json = json.loads(message)
+            timestamp = record['timestamp']
+        else:
+            message = line
+            lex_json = record
+            timestamp = record.get('timestamp')
+    else:
+        timestamp, _, message = line.partition(' ')
+        lex_json = json.loads(message)
+    session_id = lex_json.get('sessionId') if isinstance(lex_json, dict) else None
+    if not session_id or timestamp is None:
+        return None
+    return session_id, parse_timestamp(timestamp), message
+
+
+class LexLogExportIndex:
+    # A persistent SQLite index of exported Amazon Lex Conversation Logs, keyed by session ID and timestamp. Once it is
+    # built, contacts are resolved locally without any Amazon CloudWatch Logs API calls. Export files that were already
+    # ingested (same key and ETag) are skipped, so the index can be topped up with new exports incrementally.
+    def __init__(self, index_path, contact_window_millis=CONTACT_WINDOW_MILLIS):
+        self.contact_window_millis = contact_window_millis
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(index_path, check_same_thread=False)
+        self._connection.executescript('''
+            CREATE TABLE IF NOT EXISTS events (session_id TEXT NOT NULL,
+                                               timestamp INTEGER NOT NULL,
+                                               message TEXT NOT NULL,
+                                               source_key TEXT NOT NULL);
+            CREATE INDEX IF NOT EXISTS events_by_session ON events (session_id, timestamp);
+            CREATE INDEX IF NOT EXISTS events_by_source_key ON events (source_key);
+            CREATE TABLE IF NOT EXISTS ingested_files (key TEXT PRIMARY KEY, etag TEXT);
+        ''')
+
+    def ingest(self, storage, prefix=None):
+        ingested_files = 0
+        ingested_events = 0
+        for page in storage.list_pages(prefix=prefix):
+            for listed_object in page:
+                key = listed_object.get('Key')
+                with self._lock:
+                    row = self._connection.execute('SELECT etag FROM ingested_files WHERE key = ?',
+                                                   (key,)).fetchone()
+                if row is not None and row[0] == listed_object.get('ETag'):
+                    continue
+                ingested_events = ingested_events + self._ingest_file(key, listed_object.get('ETag'),
+                                                                      storage.get(key))
+                ingested_files = ingested_files + 1
+        return ingested_files, ingested_events
+
+    def _ingest_file(self, key, etag, body):
+        if body[:2] == GZIP_MAGIC:
+            body = gzip.decompress(body)
+
+        rows = []
+        skipped_lines = 0
+        for line in body.decode('utf-8').splitlines():
+            try:
+                row = parse_export_line(line)
+            except ValueError:
+                row = None
+            if row is None:
+                skipped_lines = skipped_lines + 1
+            else:
+                rows.append(row)
+
+        # Replace whatever an earlier version of the same export file contributed, in one transaction.
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM events WHERE source_key = ?', (key,))
+            for index in range(0, len(rows), INSERT_BATCH_SIZE):
+                self._connection.executemany('INSERT INTO events (session_id, timestamp, message, source_key) '
+                                             'VALUES (?, ?, ?, ?)',
+                                             [row + (key,) for row in rows[index:index + INSERT_BATCH_SIZE]])
+            self._connection.execute('INSERT OR REPLACE INTO ingested_files (key, etag) VALUES (?, ?)', (key, etag))
+
+        if skipped_lines:
+            print('[IN PROGRESS] Skipped [{0}] lines without an Amazon Lex Conversation Log in [{1}]'.format(
+                skipped_lines, key))
+        return len(rows)
+
+    def get_log_events(self, epoch_time, contact_id):
+        # Amazon Lex Conversation Logs use the Amazon Connect Contact ID as the Session ID.
+        with self._lock:
+            lex_logs = self._connection.execute('SELECT timestamp, message FROM events '
+                                                'WHERE session_id = ? AND timestamp BETWEEN ? AND ? '
+                                                'ORDER BY timestamp, rowid',
+                                                (contact_id,
+                                                 epoch_time - self.contact_window_millis,
+                                                 epoch_time + self.contact_window_millis)).fetchall()
+        found_match = len(lex_logs) > 0
+
+        if not found_match:
+            print('[IN PROGRESS] Did not find any matching Amazon Lex Conversation Logs for contact ID ' + contact_id)
+
+        return lex_logs, found_match
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,193 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import json
+import os
+import threading
+import time
+
+from storage import FILE_URI_PREFIX, S3_URI_PREFIX, get_storage
+
+
+SNAPSHOT_SEGMENT_LINES = 100000
+
+
+class _LocalManifestFile:
+    # Keeps the manifest as a single JSON lines file that every commit appends to.
+    def __init__(self, path):
+        self.path = path
+
+    def read_lines(self):
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, 'r', encoding='utf-8') as manifest_file:
+            return manifest_file.read().splitlines()
+
+    def append_lines(self, lines):
+        with open(self.path, 'a', encoding='utf-8') as manifest_file:
+            manifest_file.write(''.join(line + '\n' for line in lines))
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+
+    def replace_lines(self, lines):
+        # Write the new contents next to the file and swap them in, so a failure leaves the old file intact.
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w', encoding='utf-8') as manifest_file:
+            for line in lines:
+                manifest_file.write(line + '\n')
+            manifest_file.flush()
+            os.fsync(manifest_file.fileno())
+        os.replace(temporary_path, self.path)
+
+
+class _ManifestSegments:
+    # Amazon S3 objects cannot be appended to, so every commit writes a new, immutable segment object under the
+    # manifest prefix. Segment names sort in commit order. A completed run replaces them all with a snapshot of the
+    # manifest, so startup only ever reads the snapshot plus the segments of runs that did not complete.
+    def __init__(self, storage, prefix):
+        self.storage = storage
+        self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+        self.sequence = 0
+        self.segment_keys = []
+
+    def read_lines(self):
+        lines = []
+        for page in self.storage.list_pages(prefix=self.prefix):
+            for listed_object in page:
+                self.segment_keys.append(listed_object.get('Key'))
+                lines.extend(self.storage.get(listed_object.get('Key')).decode('utf-8').splitlines())
+        return lines
+
+    def append_lines(self, lines):
+        self.sequence = self.sequence + 1
+        key = '{}segment-{:d}-{:06d}.jsonl'.format(self.prefix, int(time.time() * 1000), self.sequence)
+        self.storage.put(key, ''.join(line + '\n' for line in lines).encode('utf-8'))
+        self.segment_keys.append(key)
+
+    def replace_lines(self, lines):
+        # Store the snapshot before deleting anything. The snapshot sorts after every older segment, so if the
+        # deletes fail, reading the older segments first still ends in the same state.
+        old_segment_keys = self.segment_keys
+        self.segment_keys = []
+        for index in range(0, len(lines), SNAPSHOT_SEGMENT_LINES):
+            self.append_lines(lines[index:index + SNAPSHOT_SEGMENT_LINES])
+        self.storage.delete(old_segment_keys)
+
+
+class Manifest:
+    # Records the source key, ETag and output key of every processed object, plus a checkpoint after each fully
+    # processed page of keys. A re-run skips objects whose ETag has not changed, and a run that did not complete
+    # resumes listing right after its last checkpoint.
+    def __init__(self, location, access_key=None, secret_key=None, region=None, api_guard=None, metrics=None):
+        # Unlike source and target locations, a bare name is a local file here, since manifests usually are.
+        if location.startswith(S3_URI_PREFIX):
+            # Manifest reads and writes share the run's retries and rate limits, and show up in its API counts.
+            storage, prefix = get_storage(location, access_key, secret_key, region, api_guard=api_guard)
+            if metrics is not None:
+                metrics.instrument_client(storage.s3_client)
+            self._backend = _ManifestSegments(storage, prefix)
+        else:
+            self._backend = _LocalManifestFile(location[len(FILE_URI_PREFIX):] if location.startswith(FILE_URI_PREFIX)
+                                               else location)
+        self._lock = threading.Lock()
+        # Commits store segments outside of _lock, so recording is never held up by a write. This lock keeps the
+        # writes themselves in commit order.
+        self._write_lock = threading.Lock()
+        self._pending = []
+        self.processed = dict()
+        self.resume_after = None
+        self.completed = False
+        self.skipped_keys = 0
+        self._load()
+
+    def _load(self):
+        for line in self._backend.read_lines():
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if 'source_key' in record:
+                self.processed[record['source_key']] = record
+                self.completed = False
+            elif 'checkpoint' in record:
+                self.resume_after = record['checkpoint']
+                self.completed = False
+            elif record.get('complete'):
+                # The previous run finished, so the next one lists from the start and relies on ETags instead.
+                self.resume_after = None
+                self.completed = True
+
+    def is_unchanged(self, s3_object):
+        record = self.processed.get(s3_object.get('Key'))
+        return record is not None and record.get('etag') == s3_object.get('ETag')
+
+    def filter_pages(self, pages):
+        # Drop every object that was already processed with the same content before it is downloaded.
+        for page in pages:
+            pending = [s3_object for s3_object in page if not self.is_unchanged(s3_object)]
+            with self._lock:
+                self.skipped_keys = self.skipped_keys + len(page) - len(pending)
+            yield pending
+
+    def record(self, source_key, etag, output_key, fingerprint=None):
+        record = {'source_key': source_key, 'etag': etag, 'output_key': output_key}
+        if fingerprint is not None:
+            # The content fingerprint lets later runs recognize duplicates of what this run wrote.
+            record['fingerprint'] = fingerprint
+        with self._lock:
+            self.processed[source_key] = record
+            self._pending.append(json.dumps(record))
+
+    def commit(self, last_key=None):
+        # Make every record so far durable, and remember that all keys up to last_key have been handled.
+        with self._write_lock:
+            with self._lock:
+                lines = self._pending
+                self._pending = []
+            records = len(lines)
+            if last_key is not None:
+                lines.append(json.dumps({'checkpoint': last_key}))
+            if lines:
+                try:
+                    self._backend.append_lines(lines)
+                except Exception:
+                    with self._lock:
+                        # Keep the records for the next commit, ahead of those recorded since.
+                        self._pending = lines[:records] + self._pending
+                    raise
+            if last_key is not None:
+                with self._lock:
+                    self.resume_after = last_key
+
+    def complete(self):
+        # Replace the manifest with one snapshot of the latest record of every key, so it does not keep growing by
+        # the records and checkpoints of every run.
+        with self._write_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+                lines = [json.dumps(self.processed[source_key]) for source_key in sorted(self.processed)]
+            lines.append(json.dumps({'complete': True}))
+            try:
+                self._backend.replace_lines(lines)
+            except Exception:
+                with self._lock:
+                    self._pending = pending + self._pending
+                raise
+            with self._lock:
+                self.resume_after = None
+                self.completed = True
@@ -0,0 +1,151 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import argparse
+import json
+import os
+import sys
+
+from manifest import Manifest
+from metrics import DEFAULT_METRICS_FORMAT, METRICS_FORMATS, Metrics
+from sharding import get_shard_location, get_shard_tag
+
+
+def merge_manifests(manifest_location, shard_count, access_key=None, secret_key=None, region=None):
+    # Report the progress of every shard, and add the records of all shards to the manifest the shards were given, so
+    # a later run over the whole source, sharded or not, skips everything any shard has processed.
+    merged_manifest = Manifest(manifest_location, access_key, secret_key, region)
+    complete_shards = 0
+    merged_keys = 0
+    for shard_index in range(shard_count):
+        shard_tag = get_shard_tag(shard_index, shard_count)
+        shard_manifest = Manifest(get_shard_location(manifest_location, shard_index, shard_count),
+                                  access_key, secret_key, region)
+        if shard_manifest.completed:
+            complete_shards = complete_shards + 1
+            status = 'complete'
+        elif shard_manifest.resume_after:
+            status = 'resumes after key [{0}]'.format(shard_manifest.resume_after)
+        elif shard_manifest.processed:
+            status = 'in progress'
+        else:
+            status = 'not started'
+        print('[IN PROGRESS] {0}: [{1}] keys processed, {2}'.format(shard_tag, len(shard_manifest.processed), status))
+
+        for source_key, record in sorted(shard_manifest.processed.items()):
+            if merged_manifest.processed.get(source_key) == record:
+                continue
+            merged_manifest.record(source_key, record.get('etag'), record.get('output_key'), record.get('fingerprint'))
+            merged_keys = merged_keys + 1
+
+    if complete_shards == shard_count:
+        merged_manifest.complete()
+    else:
+        merged_manifest.commit()
+    print('[COMPLETE] Merged [{0}] new records into [{1}], [{2}/{3}] shards complete'.format(
+        merged_keys, manifest_location, complete_shards, shard_count))
+    return complete_shards == shard_count
+
+
+def merge_metrics(metrics_file, shard_count, metrics_format=DEFAULT_METRICS_FORMAT):
+    # Shards have to write their metrics as JSON to be merged. The merged metrics can be written in either format.
+    metrics = Metrics()
+    merged_shards = 0
+    for shard_index in range(shard_count):
+        shard_metrics_file = get_shard_location(metrics_file, shard_index, shard_count)
+        if not os.path.exists(shard_metrics_file):
+            print('[IN PROGRESS] No metrics for {0} at [{1}]'.format(get_shard_tag(shard_index, shard_count),
+                                                                       shard_metrics_file))
+            continue
+        with open(shard_metrics_file, 'r', encoding='utf-8') as shard_file:
+            try:
+                snapshot = json.load(shard_file)
+            except ValueError:
+                raise ValueError('[{0}] is not a JSON metrics file, run the shards with --metrics_format json'.format(
+                    shard_metrics_file))
+        metrics.merge_snapshot(snapshot)
+        merged_shards = merged_shards + 1
+    metrics.write(metrics_file, metrics_format)
+    print(metrics.get_progress_line())
+    print('[COMPLETE] Merged the metrics of [{0}/{1}] shards into [{2}]'.format(merged_shards, shard_count,
+                                                                               metrics_file))
+
+
+def merge_dead_letters(dead_letter_file, shard_count):
+    dead_keys = 0
+    with open(dead_letter_file, 'w', encoding='utf-8') as merged_file:
+        for shard_index in range(shard_count):
+            shard_dead_letter_file = get_shard_location(dead_letter_file, shard_index, shard_count)
+            if not os.path.exists(shard_dead_letter_file):
+                continue
+            with open(shard_dead_letter_file, 'r', encoding='utf-8') as shard_file:
+                for line in shard_file:
+                    if line.strip():
+                        merged_file.write(line if line.endswith('\n') else line + '\n')
+                        dead_keys = dead_keys + 1
+    print('[COMPLETE] Merged [{0}] failed keys into [{1}]'.format(dead_keys, dead_letter_file))
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Combine the manifests, metrics and dead-letter files of the '
+                                                     'shards of a sharded run, given the same locations that were '
+                                                     'passed to every shard.')
+    arg_parser.add_argument('--shard_count', required=True, type=int, help="Number of shards the run was split into")
+    arg_parser.add_argument('--manifest', required=False, type=str,
+                            help="The --manifest location given to the shards. Records of all shards are merged "
+                                 "into it")
+    arg_parser.add_argument('--metrics_file', required=False, type=str,
+                            help="The --metrics_file given to the shards, which must have written JSON. The merged "
+                                 "metrics are written to it")
+    arg_parser.add_argument('--metrics_format', required=False, choices=METRICS_FORMATS, default=DEFAULT_METRICS_FORMAT,
+                            help="Format of the merged metrics file (default: %(default)s)")
+    arg_parser.add_argument('--dead_letter_file', required=False, type=str,
+                            help="The --dead_letter_file given to the shards. Failed keys of all shards are written "
+                                 "to it")
+    arg_parser.add_argument('--access_key', required=False, type=str,
+                            help="Access key of the credentials needed to read and write an Amazon S3 manifest")
+    arg_parser.add_argument('--secret_key', required=False, type=str,
+                            help="Secret key of the credentials needed to read and write an Amazon S3 manifest")
+    arg_parser.add_argument('--region', required=False, help="Specify the region of an Amazon S3 manifest")
+
+    arg = arg_parser.parse_args()
+    shard_count = arg.shard_count
+    manifest_location = arg.manifest
+    metrics_file = arg.metrics_file
+    metrics_format = arg.metrics_format
+    dead_letter_file = arg.dead_letter_file
+    access_key = arg.access_key
+    secret_key = arg.secret_key
+    region = arg.region
+    if shard_count < 2:
+        arg_parser.error('--shard_count must be at least 2')
+    if not (manifest_location or metrics_file or dead_letter_file):
+        arg_parser.error('at least one of --manifest, --metrics_file or --dead_letter_file is required')
+
+    complete = True
+    if manifest_location:
+        complete = merge_manifests(manifest_location, shard_count, access_key, secret_key, region)
+    if metrics_file:
+        merge_metrics(metrics_file, shard_count, metrics_format)
+    if dead_letter_file:
+        merge_dead_letters(dead_letter_file, shard_count)
+    return 0 if complete else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
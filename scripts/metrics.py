@@ -0,0 +1,308 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from storage import NEW_FILE_MODE
+
+METRICS_FORMATS = ['json', 'prometheus']
+DEFAULT_METRICS_FORMAT = 'json'
+# Upper bounds, in seconds, of the latency histogram buckets. They span local file reads to slow, throttled API calls.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+THROTTLING_ERROR_CODES = {'Throttling', 'ThrottlingException', 'ThrottledException', 'RequestThrottledException',
+                          'TooManyRequestsException', 'RequestLimitExceeded', 'SlowDown', 'RequestThrottled',
+                          'ProvisionedThroughputExceededException'}
+PROMETHEUS_NAMESPACE = 'lex_transcripts'
+BUCKET_LABELS = [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf']
+TOTAL_COUNTERS = ('items_processed', 'items_failed', 'bytes_in', 'bytes_out')
+API_COUNTERS = ('api_calls', 'api_retries', 'api_throttles', 'api_errors')
+
+
+class _Histogram:
+    def __init__(self):
+        self.bucket_counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        self.bucket_counts[index] = self.bucket_counts[index] + 1
+        self.count = self.count + 1
+        self.sum = self.sum + seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, histogram):
+        # Add in a histogram as written by to_dict().
+        for index, bound in enumerate(BUCKET_LABELS):
+            self.bucket_counts[index] = self.bucket_counts[index] + histogram['buckets'].get(bound, 0)
+        self.count = self.count + histogram['count']
+        self.sum = self.sum + histogram['seconds']
+        self.max = max(self.max, histogram['max_seconds'])
+
+    def get_quantile(self, quantile):
+        # Estimated as the upper bound of the bucket the quantile falls in, like Prometheus' histogram_quantile.
+        if not self.count:
+            return None
+        rank = quantile * self.count
+        cumulative_count = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            cumulative_count = cumulative_count + bucket_count
+            if cumulative_count >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else self.max
+        return self.max
+
+    def to_dict(self):
+        return {'count': self.count,
+                'seconds': round(self.sum, 6),
+                'mean_seconds': round(self.sum / self.count, 6) if self.count else None,
+                'p50_seconds': self.get_quantile(0.5),
+                'p99_seconds': self.get_quantile(0.99),
+                'max_seconds': round(self.max, 6),
+                'buckets': dict(zip(BUCKET_LABELS, self.bucket_counts))}
+
+
+class Metrics:
+    # Collects stage timers with latency histograms, API call, retry and throttle counts per operation, bytes read and
+    # written, and processed items, from any number of threads. Pipelines and storage report into it, and it can be
+    # written out as JSON or in the Prometheus text format, once at the end of a run or periodically while it runs.
+    def __init__(self):
+        self.started = time.monotonic()
+        self._lock = threading.Lock()
+        self._stages = dict()
+        self._counters = dict()
+        self._reporter = None
+        self._stopped = threading.Event()
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(stage, time.perf_counter() - start)
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            if stage not in self._stages:
+                self._stages[stage] = _Histogram()
+            self._stages[stage].observe(seconds)
+
+    def add(self, name, value=1, service=None, operation=None):
+        key = (name, service, operation)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def instrument_client(self, client):
+        # Every attempt of an AWS SDK call, including retries, emits a needs-retry event carrying the response, so
+        # hooking it counts calls, retries and throttling without touching the SDK's own retry handling.
+        def on_attempt(operation=None, attempts=1, response=None, caught_exception=None, **kwargs):
+            service = operation.service_model.service_id.hyphenize()
+            self.add('api_calls' if attempts == 1 else 'api_retries', service=service, operation=operation.name)
+            error_code = response[1].get('Error', {}).get('Code') if response is not None else None
+            if error_code in THROTTLING_ERROR_CODES:
+                self.add('api_throttles', service=service, operation=operation.name)
+            elif error_code or caught_exception is not None:
+                self.add('api_errors', service=service, operation=operation.name)
+
+        client.meta.events.register('needs-retry', on_attempt)
+        return client
+
+    def merge_snapshot(self, snapshot):
+        # Fold in the JSON snapshot of another run, such as one shard of a sharded run. Counters and stage histograms
+        # add up, and the elapsed time becomes that of the longest run.
+        with self._lock:
+            self.started = min(self.started, time.monotonic() - snapshot.get('elapsed_seconds', 0))
+            for name in TOTAL_COUNTERS:
+                key = (name, None, None)
+                self._counters[key] = self._counters.get(key, 0) + snapshot.get(name, 0)
+            for name in API_COUNTERS:
+                for service_operation, value in snapshot.get(name, {}).items():
+                    service, _, operation = service_operation.partition(':')
+                    key = (name, service, operation)
+                    self._counters[key] = self._counters.get(key, 0) + value
+            for stage, histogram in snapshot.get('stages', {}).items():
+                if stage not in self._stages:
+                    self._stages[stage] = _Histogram()
+                self._stages[stage].merge(histogram)
+
+    def snapshot(self):
+        with self._lock:
+            stages = {stage: histogram.to_dict() for stage, histogram in sorted(self._stages.items())}
+            counters = dict(self._counters)
+        elapsed_seconds = time.monotonic() - self.started
+        snapshot = {'elapsed_seconds': round(elapsed_seconds, 3)}
+        for name in TOTAL_COUNTERS:
+            snapshot[name] = counters.get((name, None, None), 0)
+        snapshot['items_per_second'] = round(snapshot['items_processed'] / elapsed_seconds, 3) if elapsed_seconds else 0
+        for name in API_COUNTERS:
+            by_operation = dict()
+            for (counter_name, service, operation), value in sorted(counters.items(), key=lambda item: str(item[0])):
+                if counter_name == name:
+                    by_operation['{}:{}'.format(service, operation)] = value
+            snapshot[name] = by_operation
+        snapshot['stages'] = stages
+        return snapshot
+
+    def get_progress_line(self):
+        # A single JSON line with the totals and the time spent per stage, without the histogram buckets.
+        snapshot = self.snapshot()
+        progress = {key: value for key, value in snapshot.items() if key != 'stages'}
+        for name in API_COUNTERS:
+            progress[name] = sum(snapshot[name].values())
+        progress['stages'] = {stage: {'count': histogram['count'],
+                                      'seconds': histogram['seconds'],
+                                      'p99_seconds': histogram['p99_seconds']}
+                              for stage, histogram in snapshot['stages'].items()}
+        return '[METRICS] ' + json.dumps(progress)
+
+    def to_prometheus(self):
+        snapshot = self.snapshot()
+        lines = []
+
+        def add_metric(name, metric_type, help_text, samples):
+            lines.append('# HELP {}_{} {}'.format(PROMETHEUS_NAMESPACE, name, help_text))
+            lines.append('# TYPE {}_{} {}'.format(PROMETHEUS_NAMESPACE, name, metric_type))
+            for suffix, labels, value in samples:
+                label_text = ','.join('{}="{}"'.format(label, label_value) for label, label_value in labels)
+                lines.append('{}_{}{}{} {}'.format(PROMETHEUS_NAMESPACE, name, suffix,
+                                                   '{' + label_text + '}' if label_text else '', value))
+
+        add_metric('elapsed_seconds', 'gauge', 'Time since the run started.', [('', [], snapshot['elapsed_seconds'])])
+        add_metric('items_per_second', 'gauge', 'Items processed per second.',
+                   [('', [], snapshot['items_per_second'])])
+        for name, help_text in (('items_processed', 'Items processed.'),
+                                ('items_failed', 'Items that failed.'),
+                                ('bytes_in', 'Bytes read from storage.'),
+                                ('bytes_out', 'Bytes written to storage.')):
+            add_metric(name + '_total', 'counter', help_text, [('', [], snapshot[name])])
+        for name, help_text in (('api_calls', 'AWS API calls, by operation.'),
+                                ('api_retries', 'Retried AWS API call attempts, by operation.'),
+                                ('api_throttles', 'Throttled AWS API call attempts, by operation.'),
+                                ('api_errors', 'Failed AWS API call attempts, other than throttling.')):
+            samples = []
+            for service_operation, value in snapshot[name].items():
+                service, _, operation = service_operation.partition(':')
+                samples.append(('', [('service', service), ('operation', operation)], value))
+            add_metric(name + '_total', 'counter', help_text, samples)
+
+        samples = []
+        for stage, histogram in snapshot['stages'].items():
+            cumulative_count = 0
+            for bound, bucket_count in histogram['buckets'].items():
+                cumulative_count = cumulative_count + bucket_count
+                samples.append(('_bucket', [('stage', stage), ('le', bound)], cumulative_count))
+            samples.append(('_sum', [('stage', stage)], histogram['seconds']))
+            samples.append(('_count', [('stage', stage)], histogram['count']))
+        add_metric('stage_seconds', 'histogram', 'Time spent per item in each stage.', samples)
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path, metrics_format=DEFAULT_METRICS_FORMAT):
+        if metrics_format == 'prometheus':
+            body = self.to_prometheus()
+        else:
+            body = json.dumps(self.snapshot(), indent=2) + '\n'
+        # Replace the file in one step, so a collector scraping it never reads a partial file.
+        directory = os.path.dirname(os.path.abspath(path))
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'w', encoding='utf-8') as metrics_file:
+                metrics_file.write(body)
+            # A textfile collector usually runs as another user, so the file must not stay owner-only.
+            os.chmod(temporary_path, NEW_FILE_MODE)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def start_reporting(self, interval_seconds, path=None, metrics_format=DEFAULT_METRICS_FORMAT):
+        # Print a progress line, and refresh the metrics file, every interval until stop_reporting() is called.
+        def report():
+            while not self._stopped.wait(interval_seconds):
+                print(self.get_progress_line())
+                if path:
+                    self.write(path, metrics_format)
+
+        self._reporter = threading.Thread(target=report, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+
+    def stop_reporting(self):
+        self._stopped.set()
+        if self._reporter is not None:
+            self._reporter.join()
+            self._reporter = None
+
+
+class _CountingStream:
+    # Counts the bytes read from a streamed object body.
+    def __init__(self, stream, metrics):
+        self.stream = stream
+        self.metrics = metrics
+
+    def read(self, size=-1):
+        data = self.stream.read(size) if size is not None and size >= 0 else self.stream.read()
+        self.metrics.add('bytes_in', len(data))
+        return data
+
+    def close(self):
+        self.stream.close()
+
+
+class InstrumentedStorage:
+    # Wraps a storage backend to time every listing page, get and put, and to count the bytes read and written.
+    def __init__(self, storage, metrics):
+        self.storage = storage
+        self.metrics = metrics
+        if hasattr(storage, 's3_client'):
+            metrics.instrument_client(storage.s3_client)
+
+    def list_pages(self, prefix=None, start_after=None):
+        pages = self.storage.list_pages(prefix=prefix, start_after=start_after)
+        while True:
+            with self.metrics.time('list'):
+                page = next(pages, None)
+            if page is None:
+                return
+            yield page
+
+    def list_prefixes(self, prefix=None):
+        with self.metrics.time('list'):
+            return self.storage.list_prefixes(prefix)
+
+    def get(self, key):
+        with self.metrics.time('get'):
+            body = self.storage.get(key)
+        self.metrics.add('bytes_in', len(body))
+        return body
+
+    def open(self, key):
+        # Only the time to the start of the body is a get here; reading the rest is part of whatever parses it.
+        with self.metrics.time('get'):
+            stream = self.storage.open(key)
+        return _CountingStream(stream, self.metrics)
+
+    def put(self, key, body):
+        with self.metrics.time('put'):
+            self.storage.put(key, body)
+        self.metrics.add('bytes_out', len(body))
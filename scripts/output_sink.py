@@ -0,0 +1,171 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import gzip
+import json
+import threading
+import time
+
+OUTPUT_COMPRESSIONS = ['none', 'gzip']
+DEFAULT_OUTPUT_COMPRESSION = 'none'
+# zlib level 6 (the gzip command line default) compresses JSON transcripts almost as well as level 9 at a fraction of
+# the CPU time.
+GZIP_COMPRESSION_LEVEL = 6
+
+
+def compress(body, compression=DEFAULT_OUTPUT_COMPRESSION):
+    if compression == 'gzip':
+        # A fixed modification time keeps the output byte for byte identical across runs.
+        return gzip.compress(body, compresslevel=GZIP_COMPRESSION_LEVEL, mtime=0)
+    return body
+
+
+def get_output_sink(storage, prefix, compression=DEFAULT_OUTPUT_COMPRESSION, pack_size=0, manifest=None,
+                    shard_tag=None):
+    if compression not in OUTPUT_COMPRESSIONS:
+        raise ValueError('Unknown output compression [{0}], expected one of {1}'.format(compression,
+                                                                                       OUTPUT_COMPRESSIONS))
+    if pack_size > 0:
+        return PackedOutputSink(storage, prefix, pack_size, compression, manifest, shard_tag)
+    return ObjectOutputSink(storage, prefix, compression, manifest)
+
+
+class ObjectOutputSink:
+    # Writes every transcript to its own object under the prefix. Gzipped objects get a .gz suffix.
+    def __init__(self, storage, prefix, compression=DEFAULT_OUTPUT_COMPRESSION, manifest=None):
+        self.storage = storage
+        self.prefix = prefix
+        self.compression = compression
+        self.manifest = manifest
+
+    def write(self, s3_object, file_name, body, fingerprint=None):
+        output_key = self.prefix + file_name
+        if self.compression == 'gzip':
+            output_key = output_key + '.gz'
+        self.storage.put(output_key, compress(body, self.compression))
+        if self.manifest is not None:
+            self.manifest.record(s3_object.get('Key'), s3_object.get('ETag'), output_key, fingerprint)
+
+    def checkpoint(self, last_key):
+        # Every key up to last_key has been written.
+        if self.manifest is not None:
+            self.manifest.commit(last_key)
+
+    def close(self):
+        pass
+
+
+class PackedOutputSink:
+    # Buffers transcripts and writes them pack_size at a time as a single JSON lines object, one transcript per line,
+    # next to an index object that maps every file name to the byte range of its line. With gzip, every line is
+    # compressed as its own gzip member: the whole pack still decompresses as one stream, and any single transcript
+    # can be fetched with a ranged GET and decompressed on its own.
+    #
+    # A transcript only counts as written once its pack is stored, so manifest checkpoints are held back until every
+    # transcript of the checkpointed pages has been flushed. When a pack cannot be stored, its transcripts go back into
+    # the buffer and are stored with the next pack, and the checkpoint keeps waiting for them.
+    def __init__(self, storage, prefix, pack_size, compression=DEFAULT_OUTPUT_COMPRESSION, manifest=None,
+                 shard_tag=None):
+        if pack_size < 1:
+            raise ValueError('pack_size must be at least 1')
+        self.storage = storage
+        self.prefix = prefix
+        self.pack_size = pack_size
+        self.compression = compression
+        self.manifest = manifest
+        self.packs = 0
+        self._run_id = str(int(time.time() * 1000))
+        if shard_tag:
+            # Shards of a run that start in the same millisecond must not write packs of the same name.
+            self._run_id = self._run_id + '-' + shard_tag
+        self._entries = []
+        self._pending_checkpoint = None
+        self._lock = threading.Lock()
+        # Packs are stored one at a time, so checkpoints are committed in order.
+        self._flush_lock = threading.Lock()
+
+    def write(self, s3_object, file_name, body, fingerprint=None):
+        # Compress outside of the lock, so several transcripts can be compressed at once.
+        line = compress(body + b'\n', self.compression)
+        with self._lock:
+            self._entries.append((s3_object, file_name, line, fingerprint))
+            full = len(self._entries) >= self.pack_size
+        if full:
+            try:
+                self.flush()
+            except Exception as error:
+                # This transcript is still buffered, so it has not failed. The run fails if close() cannot store it.
+                print('[ERROR] Failed to store a pack of transcripts, retrying with the next pack: {0}'.format(error))
+
+    def checkpoint(self, last_key):
+        with self._lock:
+            self._pending_checkpoint = last_key
+            flushed = not self._entries
+        if flushed:
+            # Nothing of these pages is buffered any more, but a pack holding some of them may still be in flight.
+            self.flush()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                entries = self._entries
+                self._entries = []
+                last_key = self._pending_checkpoint
+                self._pending_checkpoint = None
+            try:
+                if entries:
+                    self._write_pack(entries)
+                    entries = []
+                if self.manifest is not None and last_key is not None:
+                    self.manifest.commit(last_key)
+            except Exception:
+                # Put back whatever was not stored, ahead of what was buffered since, and keep the checkpoint.
+                with self._lock:
+                    self._entries = entries + self._entries
+                    if self._pending_checkpoint is None:
+                        self._pending_checkpoint = last_key
+                raise
+
+    def _write_pack(self, entries):
+        # Order the pack by source key, so its layout does not depend on which transcript finished first.
+        entries.sort(key=lambda entry: entry[0].get('Key'))
+        self.packs = self.packs + 1
+        pack_key = '{}transcripts-{}-{:06d}.jsonl'.format(self.prefix, self._run_id, self.packs)
+        if self.compression == 'gzip':
+            pack_key = pack_key + '.gz'
+
+        index = []
+        offset = 0
+        for s3_object, file_name, line, _ in entries:
+            index.append({'file_name': file_name,
+                          'source_key': s3_object.get('Key'),
+                          'offset': offset,
+                          'length': len(line)})
+            offset = offset + len(line)
+        self.storage.put(pack_key, b''.join(line for _, _, line, _ in entries))
+        self.storage.put(pack_key + '.index.json', json.dumps({'pack_key': pack_key,
+                                                               'compression': self.compression,
+                                                               'transcripts': index}).encode('utf-8'))
+
+        if self.manifest is not None:
+            for s3_object, _, _, fingerprint in entries:
+                self.manifest.record(s3_object.get('Key'), s3_object.get('ETag'), pack_key, fingerprint)
+
+    def close(self):
+        # Store the last, partially filled pack and commit any checkpoint that was waiting for it.
+        self.flush()
@@ -0,0 +1,175 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import collections
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 10
+
+
+def list_json_objects(storage, prefix=None, start_after=None):
+    for page in storage.list_pages(prefix=prefix, start_after=start_after):
+        yield [listed_object for listed_object in page if listed_object.get('Key').endswith('.json')]
+
+
+class DeadLetterFile:
+    # Appends every key that failed for good as a JSON line with its ETag and the error, so the run carries on and the
+    # failed keys can be looked at, or retried, afterwards.
+    def __init__(self, path):
+        self.path = path
+        self.dead_keys = 0
+        self._lock = threading.Lock()
+
+    def record(self, item, error):
+        line = json.dumps({'Key': item.get('Key'),
+                           'ETag': item.get('ETag'),
+                           'ErrorType': type(error).__name__,
+                           'Error': str(error)})
+        with self._lock:
+            with open(self.path, 'a') as dead_letter_file:
+                dead_letter_file.write(line + '\n')
+            self.dead_keys = self.dead_keys + 1
+
+
+class _Page:
+    def __init__(self, items):
+        self.items = items
+        self.remaining = len(items)
+
+
+class TransformPipeline:
+    # Runs fetch -> transform -> upload for every listed item. Fetching (and transforming) and uploading use separate
+    # bounded worker pools so the stages overlap, and the number of items held in memory at any time is capped by
+    # max_in_flight. Listing is pulled lazily from the pages iterator, so it only runs ahead while there is capacity.
+    # With a transform_executor (e.g. a ProcessPoolExecutor), the CPU-bound transform runs there instead of on the
+    # fetch threads; transform then has to be a picklable, module-level function.
+    def __init__(self, fetch, transform, upload, concurrency=DEFAULT_CONCURRENCY, max_in_flight=None,
+                 transform_executor=None, metrics=None, dead_letter=None):
+        if concurrency < 1:
+            raise ValueError('concurrency must be at least 1')
+        self.fetch = fetch
+        self.transform = transform
+        self.upload = upload
+        self.transform_executor = transform_executor
+        self.metrics = metrics
+        self.dead_letter = dead_letter
+        self.concurrency = concurrency
+        self.max_in_flight = max_in_flight or concurrency * 2
+        self.processed_keys = 0
+        self.failed_keys = 0
+        self._slots = threading.BoundedSemaphore(self.max_in_flight)
+        self._lock = threading.Lock()
+        self._pages = collections.deque()
+        self._done_pages = collections.deque()
+        self._reporting = False
+        self._report_error = None
+        self._on_page_done = None
+        self._upload_pool = None
+
+    def run(self, pages, on_page_done=None):
+        self._on_page_done = on_page_done
+        fetch_pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='fetch')
+        self._upload_pool = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='upload')
+        try:
+            for items in pages:
+                page = _Page(items)
+                with self._lock:
+                    self._pages.append(page)
+                    self._complete_pages()
+                self._report_pages()
+                for item in items:
+                    # Wait for a free slot before handing out more work, so a slow stage applies backpressure all
+                    # the way up to the listing.
+                    self._slots.acquire()
+                    fetch_pool.submit(self._fetch_and_transform, page, item)
+        finally:
+            # The fetch workers are the only producers of upload work, so they have to drain first.
+            fetch_pool.shutdown(wait=True)
+            self._upload_pool.shutdown(wait=True)
+        if self._report_error is not None:
+            # A page could not be reported, for example because its checkpoint could not be stored. That happened on
+            # a worker thread, so fail the run here instead of returning as if every page was committed.
+            raise self._report_error
+        return self.processed_keys, self.failed_keys
+
+    def _fetch_and_transform(self, page, item):
+        try:
+            body = self.fetch(item)
+            if self.transform_executor is not None:
+                result = self.transform_executor.submit(self.transform, item, body).result()
+            else:
+                result = self.transform(item, body)
+            self._upload_pool.submit(self._upload, page, item, result)
+        except Exception as error:
+            self._finish(page, item, error)
+
+    def _upload(self, page, item, result):
+        try:
+            self.upload(item, result)
+        except Exception as error:
+            self._finish(page, item, error)
+        else:
+            self._finish(page, item)
+
+    def _finish(self, page, item, error=None):
+        with self._lock:
+            if error is None:
+                self.processed_keys = self.processed_keys + 1
+            else:
+                self.failed_keys = self.failed_keys + 1
+                print('[ERROR] Failed to transform key [{0}]: {1}'.format(item.get('Key'), error))
+                if self.dead_letter is not None:
+                    self.dead_letter.record(item, error)
+            if self.metrics is not None:
+                self.metrics.add('items_processed' if error is None else 'items_failed')
+            page.remaining = page.remaining - 1
+            self._complete_pages()
+        self._slots.release()
+        self._report_pages()
+
+    def _complete_pages(self):
+        # Called with the lock held. Queue pages strictly in listing order, once every item on the page has either
+        # been uploaded or failed.
+        while self._pages and self._pages[0].remaining == 0:
+            self._done_pages.append(self._pages.popleft())
+
+    def _report_pages(self):
+        # on_page_done may write a checkpoint to Amazon S3, so it runs outside of the lock and does not hold up other
+        # workers. One thread at a time reports every queued page in order, and whoever finds a report in progress
+        # leaves its pages to that thread.
+        with self._lock:
+            if self._reporting:
+                return
+            self._reporting = True
+        try:
+            while True:
+                with self._lock:
+                    if not self._done_pages:
+                        self._reporting = False
+                        return
+                    page = self._done_pages.popleft()
+                if self._on_page_done:
+                    self._on_page_done(page.items)
+        except Exception as error:
+            with self._lock:
+                self._reporting = False
+                if self._report_error is None:
+                    self._report_error = error
+            raise
@@ -0,0 +1,176 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import io
+import json
+import re
+
+# Field specs name the top-level fields to keep. A field maps to None to keep its whole value, or to a nested spec when
+# it holds an array of objects of which only the named fields are kept.
+CALL_ANALYTICS_FIELDS = {'ContentMetadata': None,
+                         'Participants': None,
+                         'Transcript': {'Id': None, 'Content': None, 'ParticipantRole': None}}
+CONNECT_CHAT_FIELDS = {'ContactId': None,
+                       'Transcript': {'AbsoluteTime': None, 'ContentType': None, 'Id': None, 'Content': None,
+                                      'ParticipantId': None, 'ParticipantRole': None}}
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+DECODER = json.JSONDecoder()
+
+
+def get_selective_parser():
+    # ijson parses straight from the response stream, so memory stays bounded by the selected fields. Without it, the
+    # body is read into memory and the selected arrays are decoded one entry at a time, so only a single entry is ever
+    # held in full, which is what makes the difference for transcripts with thousands of segments.
+    try:
+        import ijson
+    except ImportError:
+        return 'scanner'
+    return 'ijson'
+
+
+def load_fields(source, fields):
+    # Parse only the selected fields of a JSON document, given as bytes or as a binary stream. A stream is closed once
+    # it has been read.
+    if hasattr(source, 'read'):
+        try:
+            if get_selective_parser() == 'ijson':
+                return _load_with_ijson(source, fields)
+            body = source.read()
+        finally:
+            source.close()
+    else:
+        body = source
+        if get_selective_parser() == 'ijson':
+            return _load_with_ijson(io.BytesIO(body), fields)
+    text = body.decode('utf-8') if isinstance(body, bytes) else body
+    position = _skip_whitespace(text, 0)
+    if text[position:position + 1] != '{':
+        # Not an object, so there are no fields to select.
+        return json.loads(text)
+    value, position = _scan_object(text, position, fields)
+    position = _skip_whitespace(text, position)
+    if position != len(text):
+        raise json.JSONDecodeError('Extra data', text, position)
+    return value
+
+
+def _load_with_ijson(stream, fields):
+    # Walk the parse events once. Values of selected fields are built as they stream past, everything else is dropped
+    # event by event, so no unselected value is ever held in memory.
+    import ijson
+    from ijson.common import ObjectBuilder
+
+    result = dict()
+    arrays = dict()
+    item = None
+    builder = None
+    builder_prefix = None
+    target = None
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is not None:
+            if prefix == builder_prefix or prefix.startswith(builder_prefix + '.'):
+                builder.event(event, value)
+                continue
+            # The selected value is complete once the parser has moved past it.
+            target[0][target[1]] = builder.value
+            builder = None
+
+        if event == 'map_key':
+            if prefix == '' and value in fields:
+                if fields[value] is None:
+                    builder, builder_prefix, target = ObjectBuilder(), value, (result, value)
+                else:
+                    arrays[value + '.item'] = fields[value]
+                    result[value] = list()
+            elif item is not None and prefix in arrays and value in arrays[prefix]:
+                builder, builder_prefix, target = ObjectBuilder(), prefix + '.' + value, (item, value)
+        elif prefix in arrays:
+            if event == 'start_map':
+                item = dict()
+                result[prefix[:-len('.item')]].append(item)
+            elif event == 'end_map':
+                item = None
+            elif event not in ('start_array', 'end_array'):
+                result[prefix[:-len('.item')]].append(value)
+        elif prefix in fields and event not in ('start_array', 'end_array', 'start_map', 'end_map'):
+            # A field that should hold an array of objects holds a single value, such as null, instead.
+            result[prefix] = value
+    if builder is not None:
+        target[0][target[1]] = builder.value
+    return result
+
+
+def _skip_whitespace(text, position):
+    return WHITESPACE.match(text, position).end()
+
+
+def _select(value, fields):
+    if fields is None:
+        return value
+    if isinstance(value, list):
+        return [_select(item, fields) for item in value]
+    if isinstance(value, dict):
+        return dict((key, _select(value[key], fields[key])) for key in value if key in fields)
+    return value
+
+
+def _scan_object(text, position, fields):
+    # Walk the top-level object key by key. Values are decoded by the C decoder, and arrays of objects that are
+    # selected in part are decoded entry by entry, dropping the unselected fields of each entry right away. Malformed
+    # documents fail with the same errors json.loads raises.
+    result = dict()
+    position = _skip_whitespace(text, position + 1)
+    if text[position:position + 1] == '}':
+        return result, position + 1
+    while True:
+        if text[position:position + 1] != '"':
+            raise json.JSONDecodeError('Expecting property name enclosed in double quotes', text, position)
+        key, position = DECODER.raw_decode(text, position)
+        position = _skip_whitespace(text, position)
+        if text[position:position + 1] != ':':
+            raise json.JSONDecodeError("Expecting ':' delimiter", text, position)
+        position = _skip_whitespace(text, position + 1)
+        if key in fields and fields[key] is not None and text[position:position + 1] == '[':
+            result[key], position = _scan_array(text, position, fields[key])
+        else:
+            value, position = DECODER.raw_decode(text, position)
+            if key in fields:
+                result[key] = _select(value, fields[key])
+        position = _skip_whitespace(text, position)
+        if text[position:position + 1] == '}':
+            return result, position + 1
+        if text[position:position + 1] != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+        position = _skip_whitespace(text, position + 1)
+
+
+def _scan_array(text, position, fields):
+    result = list()
+    position = _skip_whitespace(text, position + 1)
+    if text[position:position + 1] == ']':
+        return result, position + 1
+    while True:
+        value, position = DECODER.raw_decode(text, position)
+        result.append(_select(value, fields))
+        position = _skip_whitespace(text, position)
+        if text[position:position + 1] == ']':
+            return result, position + 1
+        if text[position:position + 1] != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+        position = _skip_whitespace(text, position + 1)
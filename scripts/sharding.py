@@ -0,0 +1,54 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import hashlib
+import os
+
+SHARD_HASH_BYTES = 8
+# A different hash than key sampling uses, so a sample and a shard of the same size select different keys.
+SHARD_HASH_PERSON = b'shard'
+
+
+def get_shard(key, shard_count):
+    # The shard a key belongs to. It only depends on the key and the shard count, so every node computes the same
+    # partition of the keys without talking to the others.
+    digest = hashlib.blake2b(key.encode('utf-8'), digest_size=SHARD_HASH_BYTES, person=SHARD_HASH_PERSON).digest()
+    return int.from_bytes(digest, 'big') % shard_count
+
+
+def get_shard_tag(shard_index, shard_count):
+    return 'shard-{0}-of-{1}'.format(shard_index, shard_count)
+
+
+def get_shard_location(location, shard_index, shard_count):
+    # Every shard keeps its progress and metrics next to the location it was given, with the shard in the name:
+    # manifest.jsonl becomes manifest.shard-3-of-16.jsonl, and an s3://bucket/manifest prefix becomes
+    # s3://bucket/manifest.shard-3-of-16. Without sharding, the location is used as it is.
+    if not location or shard_count <= 1:
+        return location
+    trailing_slash = '/' if location.endswith('/') else ''
+    location = location.rstrip('/')
+    head, _, name = location.rpartition('/')
+    if head.endswith(':/'):
+        # A bare bucket, which cannot be renamed, so the shard gets a prefix in it instead.
+        return '{0}/{1}{2}'.format(location, get_shard_tag(shard_index, shard_count), trailing_slash)
+    stem, extension = os.path.splitext(name)
+    if not stem:
+        stem, extension = extension, ''
+    name = '{0}.{1}{2}'.format(stem, get_shard_tag(shard_index, shard_count), extension)
+    return (head + '/' if head else '') + name + trailing_slash
@@ -19,12 +19,30 @@
 # !/usr/bin/env python
 # -*- coding: utf-8 -*-
 import argparse
+import asyncio
+import collections
 import json
 import sys
 import uuid
 from dateutil import parser
 
-import boto3
+from api_guard import DEFAULT_MAX_ATTEMPTS, ApiGuard, parse_rate_limit
+from async_pipeline import AsyncPipeline
+from cloudwatch_log_index import CloudWatchLogWindowIndex
+from json_codec import DEFAULT_JSON_CODEC, JSON_CODECS, get_json_codec
+from key_discovery import DEFAULT_LISTING_DEPTH, DEFAULT_LISTING_SPLIT, LISTING_SPLITS, get_key_source
+from key_filter import add_key_filter_arguments, get_key_filter
+from lex_log_export_index import LexLogExportIndex
+from manifest import Manifest
+from metrics import DEFAULT_METRICS_FORMAT, METRICS_FORMATS, InstrumentedStorage, Metrics
+from output_sink import DEFAULT_OUTPUT_COMPRESSION, OUTPUT_COMPRESSIONS, ObjectOutputSink, get_output_sink
+from pipeline import DEFAULT_CONCURRENCY, DeadLetterFile, list_json_objects
+from sharding import get_shard_location, get_shard_tag
+from storage import get_storage
+from turn_export import DEFAULT_TURN_EXPORT_FORMAT, DEFAULT_TURN_EXPORT_ROWS, TURN_EXPORT_FORMATS, TurnExportSink, get_turns
+
+# Namespace of the deterministic IDs given to Amazon Lex turns added to a transcript.
+LEX_TRANSCRIPT_NAMESPACE = uuid.UUID('6f1f6c7e-8a3b-4c55-9d0e-2b7a5e4c1d93')
 
 
 def main():
@@ -32,7 +50,7 @@ def main():
                                                      'look-up corresponding Amazon Lex conversation logs from a configured '
                                                      'Amazon CloudWatch Logs ARN, stitch them together and upload it into the '
                                                      'same Amazon S3 bucket under a new path.')
-    arg_parser.add_argument('--source', required=True, type=str, help="Set the source Amazon S3 bucket containing Contact "
+    arg_parser.add_argument('--source', required=True, type=str, help="Set the source Amazon S3 bucket (or local directory) containing Contact "
                                                                       "Lens transcripts")
     arg_parser.add_argument('--access_key', required=False, type=str,
                             help="Access key of the credentials needed to query "
@@ -40,9 +58,79 @@ def main():
     arg_parser.add_argument('--secret_key', required=False, type=str,
                             help="Secret key of the credentials needed to query "
                                  "Amazon S3 and Amazon CloudWatch")
-    arg_parser.add_argument('--region', required=True, help="Specify the region. This flag is required")
-    arg_parser.add_argument('--cloudwatch_log_group_name', required=True, help="Specify the Amazon CloudWatch Log Group name "
-                                                                               "containing the Amazon Lex Conversation Logs")
+    arg_parser.add_argument('--region', required=False, help="Specify the region. This flag is required when Amazon S3 or "
+                                                             "Amazon CloudWatch Logs are used")
+    arg_parser.add_argument('--cloudwatch_log_group_name', required=False, help="Specify the Amazon CloudWatch Log Group name "
+                                                                                "containing the Amazon Lex Conversation Logs. "
+                                                                                "Required unless --lex_log_index is set")
+    arg_parser.add_argument('--batch_cloudwatch_lookups', required=False, action='store_true',
+                            help="Pull the Amazon Lex Conversation Logs once per time window for each page of Contact "
+                                 "Lens transcripts and resolve contacts from an in-memory index, instead of running "
+                                 "one Amazon CloudWatch Logs query per contact")
+    arg_parser.add_argument('--manifest', required=False, type=str,
+                            help="Local file or s3://bucket/prefix location of the manifest of processed keys. Unchanged "
+                                 "keys are skipped and an interrupted run resumes after its last completed page")
+    arg_parser.add_argument('--lex_log_export', required=False, type=str,
+                            help="Local directory or s3://bucket/prefix location of exported Amazon Lex Conversation "
+                                 "Logs (gzipped JSON lines, as written by an Amazon CloudWatch Logs export) to ingest "
+                                 "into the --lex_log_index before stitching")
+    arg_parser.add_argument('--concurrency', required=False, type=int, default=DEFAULT_CONCURRENCY,
+                            help="Maximum number of Amazon S3 and Amazon CloudWatch Logs requests in flight "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument('--json_codec', required=False, choices=JSON_CODECS, default=DEFAULT_JSON_CODEC,
+                            help="JSON library used to decode and encode transcripts (default: %(default)s)")
+    arg_parser.add_argument('--lex_log_index', required=False, type=str,
+                            help="Path of the SQLite index of exported Amazon Lex Conversation Logs. When set, "
+                                 "contacts are matched from the index and Amazon CloudWatch Logs is not queried")
+    arg_parser.add_argument('--output_compression', required=False, choices=OUTPUT_COMPRESSIONS,
+                            default=DEFAULT_OUTPUT_COMPRESSION,
+                            help="Compression of the stitched transcripts. Gzipped objects get a .gz suffix "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument('--pack_size', required=False, type=int, default=0,
+                            help="Upload stitched transcripts in packs of this many, as one JSON lines object with an "
+                                 "index object next to it, instead of one object per transcript")
+    arg_parser.add_argument('--inventory', required=False, type=str,
+                            help="Local path or s3:// URI of the manifest.json of an Amazon S3 Inventory report of the "
+                                 "source bucket. Keys are read from the report instead of being listed")
+    arg_parser.add_argument('--listing_concurrency', required=False, type=int, default=1,
+                            help="Number of key ranges of the source listed in parallel (default: %(default)s)")
+    arg_parser.add_argument('--listing_split', required=False, choices=LISTING_SPLITS, default=DEFAULT_LISTING_SPLIT,
+                            help="Split the parallel listing by '/'-separated sub-prefixes, such as dates, or by the "
+                                 "first character after the prefix (default: %(default)s)")
+    arg_parser.add_argument('--listing_depth', required=False, type=int, default=DEFAULT_LISTING_DEPTH,
+                            help="Number of '/'-separated levels a prefix split descends (default: %(default)s)")
+    arg_parser.add_argument('--metrics_file', required=False, type=str,
+                            help="Write run metrics (stage timers and latency histograms, API call, retry and throttle "
+                                 "counts, bytes and items per second) to this file")
+    arg_parser.add_argument('--metrics_format', required=False, choices=METRICS_FORMATS,
+                            default=DEFAULT_METRICS_FORMAT, help="Format of the metrics file (default: %(default)s)")
+    arg_parser.add_argument('--metrics_interval', required=False, type=float, default=0,
+                            help="Print a metrics progress line, and refresh the metrics file, every this many seconds")
+    add_key_filter_arguments(arg_parser)
+    arg_parser.add_argument('--max_attempts', required=False, type=int, default=DEFAULT_MAX_ATTEMPTS,
+                            help="Attempts per AWS API call before it fails. Throttling, server and connection errors "
+                                 "are retried with jittered exponential backoff (default: %(default)s)")
+    arg_parser.add_argument('--rate_limit', required=False, type=parse_rate_limit, action='append',
+                            help="Cap an AWS API operation at a number of requests per second, as OPERATION=RATE, "
+                                 "such as GetObject=3000. Can be given several times")
+    arg_parser.add_argument('--dead_letter_file', required=False, type=str,
+                            help="Append every key that fails, with its ETag and the error, to this JSON lines file")
+    arg_parser.add_argument('--shard_index', required=False, type=int, default=0,
+                            help="Process only the keys of this shard, numbered from 0 (default: %(default)s)")
+    arg_parser.add_argument('--shard_count', required=False, type=int, default=1,
+                            help="Split the keys into this many shards by a stable hash of the key, so several nodes "
+                                 "can each process one shard of the same source (default: %(default)s)")
+    arg_parser.add_argument('--turn_export', required=False, type=str,
+                            help="Also write every transcript turn (contact ID, turn index, participant role, content, "
+                                 "whether it came from Amazon Lex and source key) to large files partitioned by "
+                                 "conversation date under this Amazon S3 bucket/prefix or local directory")
+    arg_parser.add_argument('--turn_export_format', required=False, choices=TURN_EXPORT_FORMATS,
+                            default=DEFAULT_TURN_EXPORT_FORMAT,
+                            help="Format of the turn export files: gzipped JSON lines, or Parquet, which requires "
+                                 "pyarrow (default: %(default)s)")
+    arg_parser.add_argument('--turn_export_rows', required=False, type=int, default=DEFAULT_TURN_EXPORT_ROWS,
+                            help="Number of turns buffered before the turn export files are written "
+                                 "(default: %(default)s)")
 
     arg = arg_parser.parse_args()
     source = arg.source
@@ -50,113 +138,374 @@ def main():
     secret_key = arg.secret_key
     region = arg.region
     cloudwatch_log_group_name = arg.cloudwatch_log_group_name
+    batch_cloudwatch_lookups = arg.batch_cloudwatch_lookups
+    manifest_location = arg.manifest
+    lex_log_export = arg.lex_log_export
+    lex_log_index_path = arg.lex_log_index
+    concurrency = arg.concurrency
+    json_codec = get_json_codec(arg.json_codec)
+    output_compression = arg.output_compression
+    pack_size = arg.pack_size
+    inventory = arg.inventory
+    listing_concurrency = arg.listing_concurrency
+    listing_split = arg.listing_split
+    listing_depth = arg.listing_depth
+    metrics_file = arg.metrics_file
+    metrics_format = arg.metrics_format
+    metrics_interval = arg.metrics_interval
+    max_attempts = arg.max_attempts
+    rate_limits = dict(arg.rate_limit or [])
+    dead_letter_file = arg.dead_letter_file
+    shard_index = arg.shard_index
+    shard_count = arg.shard_count
+    turn_export = arg.turn_export
+    turn_export_format = arg.turn_export_format
+    turn_export_rows = arg.turn_export_rows
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        arg_parser.error('--shard_index must be between 0 and --shard_count - 1')
+    shard_tag = get_shard_tag(shard_index, shard_count) if shard_count > 1 else None
+    if shard_tag:
+        # Every shard keeps its own manifest, metrics and dead-letter file, which merge_shards.py combines.
+        print('[IN PROGRESS] Processing {0}'.format(shard_tag))
+        manifest_location = get_shard_location(manifest_location, shard_index, shard_count)
+        metrics_file = get_shard_location(metrics_file, shard_index, shard_count)
+        dead_letter_file = get_shard_location(dead_letter_file, shard_index, shard_count)
+
+    if lex_log_export and not lex_log_index_path:
+        arg_parser.error('--lex_log_export requires --lex_log_index')
+    if not lex_log_index_path and not cloudwatch_log_group_name:
+        arg_parser.error('either --cloudwatch_log_group_name or --lex_log_index is required')
+
+    # Time every listing page, download and upload, and count API calls and bytes along the way.
+    metrics = Metrics()
+    # Every AWS API call of the run goes through one guard, which rate limits, adapts concurrency and retries.
+    api_guard = ApiGuard(concurrency, rate_limits, max_attempts)
+    dead_letter = DeadLetterFile(dead_letter_file) if dead_letter_file else None
+    source_storage, source_prefix = get_storage(source, access_key, secret_key, region,
+                                                max_pool_connections=concurrency, api_guard=api_guard)
+    source_storage = InstrumentedStorage(source_storage, metrics)
+
+    cloudwatch_client = None
+    lex_log_index = None
+    if lex_log_index_path:
+        # Resolve contacts from the offline index of exported logs, without any Amazon CloudWatch Logs API calls.
+        lex_log_index = LexLogExportIndex(lex_log_index_path)
+        if lex_log_export:
+            export_storage, export_prefix = get_storage(lex_log_export, access_key, secret_key, region,
+                                                        api_guard=api_guard)
+            ingested_files, ingested_events = lex_log_index.ingest(export_storage, export_prefix)
+            print('[IN PROGRESS] Indexed [{0}] Amazon Lex Conversation Logs from [{1}] new export files'.format(
+                ingested_events, ingested_files))
+    else:
+        # Only import the AWS SDK when Amazon CloudWatch Logs is actually queried.
+        import boto3
+        from botocore.config import Config
+
+        cloudwatch_client = boto3.client('logs',
+                                         aws_access_key_id=access_key,
+                                         aws_secret_access_key=secret_key,
+                                         region_name=region,
+                                         config=Config(max_pool_connections=concurrency,
+                                                       retries=api_guard.sdk_retries))
+        api_guard.attach(cloudwatch_client)
+        metrics.instrument_client(cloudwatch_client)
+        if batch_cloudwatch_lookups:
+            lex_log_index = CloudWatchLogWindowIndex(cloudwatch_client, cloudwatch_log_group_name)
+
+    manifest = None
+    if manifest_location:
+        manifest = Manifest(manifest_location, access_key, secret_key, region, api_guard, metrics)
+        if manifest.resume_after:
+            print('[IN PROGRESS] Resuming after key [{0}]'.format(manifest.resume_after))
+    # Stitched transcripts go back into the source location under a new path.
+    output_sink = get_output_sink(source_storage, source_prefix + 'AnalysisWithLexLogs/', output_compression,
+                                  pack_size, manifest, shard_tag)
+    if turn_export:
+        turn_export_storage, turn_export_prefix = get_storage(turn_export, access_key, secret_key, region,
+                                                              max_pool_connections=concurrency, api_guard=api_guard)
+        output_sink = TurnExportSink(output_sink, InstrumentedStorage(turn_export_storage, metrics),
+                                     turn_export_prefix, turn_export_format, turn_export_rows, shard_tag)
+
+    # List the keys to stitch, with Amazon S3 ListObjects or from an Amazon S3 Inventory report.
+    key_source = get_key_source(source_storage, inventory, listing_concurrency, listing_split, listing_depth,
+                                access_key, secret_key, region, api_guard, metrics)
+    pages = list_json_objects(key_source, source_prefix + 'Analysis/',
+                              start_after=manifest.resume_after if manifest else None)
+    key_filter = get_key_filter(arg)
+    if key_filter.is_active():
+        # Select keys on their listing metadata and names alone, so nothing outside the selection is downloaded.
+        pages = key_filter.filter_pages(pages)
+    if manifest is not None:
+        # Skip Contact Lens files that were already stitched and have not changed since.
+        pages = manifest.filter_pages(pages)
+
+    if metrics_interval > 0:
+        metrics.start_reporting(metrics_interval, metrics_file, metrics_format)
+    try:
+        processed_keys, failed_keys, matched_keys = asyncio.run(stitch_all(pages,
+                                                                           source_storage,
+                                                                           source_prefix,
+                                                                           cloudwatch_log_group_name,
+                                                                           cloudwatch_client,
+                                                                           lex_log_index,
+                                                                           manifest,
+                                                                           concurrency,
+                                                                           json_codec,
+                                                                           output_sink,
+                                                                           metrics,
+                                                                           dead_letter))
+    finally:
+        metrics.stop_reporting()
+
+    print(metrics.get_progress_line())
+    if metrics_file:
+        metrics.write(metrics_file, metrics_format)
+
+    if manifest is not None:
+        manifest.complete()
+        print('[COMPLETE] Skipped [{0}] unchanged keys'.format(manifest.skipped_keys))
+    if key_filter.is_active():
+        print('[COMPLETE] Skipped [{0}] keys outside the selection'.format(key_filter.filtered_keys))
+    if turn_export:
+        print('[COMPLETE] Exported [{0}] turns in [{1}] files'.format(output_sink.exported_turns, output_sink.files))
+
+    if dead_letter is not None and dead_letter.dead_keys:
+        print('[COMPLETE] Wrote [{0}] failed keys to [{1}]'.format(dead_letter.dead_keys, dead_letter_file))
+
+    if failed_keys:
+        print('[COMPLETE] Successfully stitched [{0}/{1}] keys, failed to stitch [{2}] keys'.format(matched_keys,
+                                                                                                   processed_keys,
+                                                                                                   failed_keys))
+        return 1
+    print('[COMPLETE] Successfully stitched [{0}/{1}] keys'.format(matched_keys, processed_keys))
 
-    s3_client = boto3.client('s3',
-                             aws_access_key_id=access_key,
-                             aws_secret_access_key=secret_key,
-                             region_name=region)
-    cloudwatch_client = boto3.client('logs',
-                                     aws_access_key_id=access_key,
-                                     aws_secret_access_key=secret_key,
-                                     region_name=region)
-
-    more_keys_left = True
-    continuation_token = None
-    processed_keys = 0
-    matched_keys = 0
-
-    # Call Amazon S3 ListObjects to fetch all the keys in the bucket.
-    while more_keys_left:
-        if continuation_token:
-            s3_objects = s3_client.list_objects_v2(Bucket=source,
-                                                   ContinuationToken=continuation_token,
-                                                   Prefix='Analysis/')
-        else:
-            s3_objects = s3_client.list_objects_v2(Bucket=source,
-                                                   Prefix='Analysis/')
-
-        # For each Amazon S3 object, attempt to perform the transformation.
-        for s3_object in s3_objects.get('Contents'):
-            if s3_object.get('Key').endswith('.json'):
-                # Retrieve the object and read the file.
-                s3_file = s3_client.get_object(Bucket=source,
-                                               Key=s3_object.get('Key'))
-                data = s3_file.get('Body').read().decode('utf-8')
-
-                # Transform the file by appending Amazon Lex Conversation Logs, if any is present.
-                updated_data, found_match = stitch_conversation_logs(data,
-                                                                     s3_object.get('Key'),
-                                                                     cloudwatch_log_group_name,
-                                                                     cloudwatch_client)
-
-                # Upload the object back into the original bucket under a new path.
-                s3_client.put_object(Bucket=source,
-                                     Key='AnalysisWithLexLogs/' + s3_object.get('Key'),
-                                     Body=bytes(json.dumps(updated_data).encode('UTF-8')))
-
-                # Keep track of number of original Contact Lens files processed.
-                processed_keys = processed_keys + 1
-
-                if found_match:
-                    # Keep track of how many of those Contact Lens files were successfully matched and stitched with
-                    # Amazon Lex Conversation Logs.
-                    matched_keys = matched_keys + 1
-
-        # If more results are available, continue pagination.
-        if s3_objects.get('IsTruncated'):
-            continuation_token = s3_objects.get('NextContinuationToken')
-        else:
-            more_keys_left = False
-
-        print('[IN PROGRESS] Successfully stitched [{0}/{1}] keys'.format(matched_keys, processed_keys))
 
-    print('[COMPLETE] Successfully stitched [{0}/{1}] keys'.format(matched_keys, processed_keys))
+async def stitch_all(pages,
+                     source_storage,
+                     source_prefix,
+                     cloudwatch_log_group_name,
+                     cloudwatch_client,
+                     lex_log_index,
+                     manifest,
+                     concurrency,
+                     json_codec=None,
+                     output_sink=None,
+                     metrics=None,
+                     dead_letter=None):
+    # Stitch every Contact Lens file with up to `concurrency` Amazon S3 and Amazon CloudWatch Logs requests in flight.
+    # Every contact is handed to the output sink, and pages are committed to the manifest in listing order.
+    metrics = metrics or Metrics()
+    pipeline = AsyncPipeline(concurrency=concurrency, metrics=metrics, dead_letter=dead_letter)
+    json_codec = json_codec or get_json_codec()
+    if output_sink is None:
+        output_sink = ObjectOutputSink(source_storage, source_prefix + 'AnalysisWithLexLogs/', manifest=manifest)
+    export_turns = isinstance(output_sink, TurnExportSink)
+    matched_keys = 0
+    pending_window_starts = collections.deque()
+
+    async def load_lex_logs(page):
+        # Pull the Amazon Lex Conversation Logs for every contact on this page in as few time windows as possible,
+        # keeping whatever contacts of earlier, unfinished pages may still look up.
+        epoch_times = get_conversation_epoch_times(page)
+        pending_window_starts.append(min(epoch_times) - lex_log_index.contact_window_millis if epoch_times else None)
+        window_starts = [window_start for window_start in pending_window_starts if window_start is not None]
+        await pipeline.call(load_windows, epoch_times, min(window_starts) if window_starts else None)
+
+    def load_windows(epoch_times, evict_before):
+        with metrics.time('load_logs'):
+            lex_log_index.load(epoch_times, evict_before)
+
+    def look_up(epoch_time, contact_id):
+        with metrics.time('lookup'):
+            return get_lex_log_events(epoch_time, contact_id, cloudwatch_log_group_name, cloudwatch_client,
+                                      lex_log_index)
+
+    async def stitch_contact(s3_object):
+        nonlocal matched_keys
+        key = s3_object.get('Key')
+
+        # Retrieve the object and read the file.
+        body = await pipeline.call(source_storage.get, key)
+        with metrics.time('parse'):
+            json_data = json_codec.loads(body)
+
+        # Transform the file by appending Amazon Lex Conversation Logs, if any is present.
+        contact_id = json_data['CustomerMetadata']['ContactId']
+        lex_log_events, found_match = await pipeline.call(look_up, get_conversation_epoch_time(key), contact_id)
+        contact_lens_turns = len(json_data['Transcript'])
+        with metrics.time('stitch'):
+            updated_data = stitch_lex_log_events(json_data, lex_log_events)
+        with metrics.time('serialize'):
+            updated_body = json_codec.dumps(updated_data)
+
+        turns = None
+        if export_turns:
+            # Every turn the stitch added is an Amazon Lex turn, numbered in order by get_lex_turns.
+            lex_turn_ids = {get_lex_transcript_id(contact_id, turn_index)
+                            for turn_index in range(len(updated_data['Transcript']) - contact_lens_turns)}
+            turns = get_turns(updated_data, key, lex_turn_ids)
+
+        # Upload the object back into the original bucket under a new path.
+        file_name = key[len(source_prefix):]
+        await pipeline.call(output_sink.write, s3_object, file_name, updated_body)
+        if turns is not None:
+            # The stitched transcript is uploaded at this point, so a failure here is reported as a TurnExportError
+            # rather than as a failed upload.
+            await pipeline.call(output_sink.export, file_name, turns)
+
+        if found_match:
+            # Keep track of how many of those Contact Lens files were successfully matched and stitched with
+            # Amazon Lex Conversation Logs.
+            matched_keys = matched_keys + 1
+
+    async def complete_page(page):
+        if pending_window_starts:
+            pending_window_starts.popleft()
+        if page:
+            await pipeline.call(output_sink.checkpoint, page[-1].get('Key'))
+        print('[IN PROGRESS] Successfully stitched [{0}/{1}] keys'.format(matched_keys, pipeline.processed_keys))
+
+    processed_keys, failed_keys = await pipeline.run(
+        pages,
+        stitch_contact,
+        on_page_start=load_lex_logs if isinstance(lex_log_index, CloudWatchLogWindowIndex) else None,
+        on_page_done=complete_page)
+    output_sink.close()
+    return processed_keys, failed_keys, matched_keys
 
 
 def stitch_conversation_logs(data,
                              file_name,
                              cloudwatch_log_group_name,
-                             cloudwatch_client):
+                             cloudwatch_client,
+                             lex_log_index=None):
     json_data = json.loads(data)
     contact_id = json_data['CustomerMetadata']['ContactId']
-    customer_id = get_participant_id(json_data, 'CUSTOMER')
-    agent_id = get_participant_id(json_data, 'AGENT')
-    conversation_timestamp = file_name[(len(file_name) - 25):(len(file_name) - 5)]
-    utc_time = parser.parse(conversation_timestamp)
-    epoch_time = int(utc_time.timestamp() * 1000)
+    epoch_time = get_conversation_epoch_time(file_name)
 
+    lex_log_events, found_match = get_lex_log_events(epoch_time,
+                                                     contact_id,
+                                                     cloudwatch_log_group_name,
+                                                     cloudwatch_client,
+                                                     lex_log_index)
+    return stitch_lex_log_events(json_data, lex_log_events), found_match
+
+
+def get_lex_log_events(epoch_time, contact_id, cloudwatch_log_group_name, cloudwatch_client, lex_log_index=None):
     # Amazon Lex Conversation Logs use the Amazon Connect Contact ID as the Session ID. Attempt to find any matching logs.
-    lex_logs, found_match = get_cloudwatch_logs(cloudwatch_log_group_name,
-                                                cloudwatch_client,
-                                                epoch_time,
-                                                contact_id)
-
-    # Reverse the list of Amazon Lex logs (ordered by time) and add each to the top of the list of transcripts.
-    lex_logs.reverse()
-    for lex_log in lex_logs:
+    if lex_log_index is not None:
+        return lex_log_index.get_log_events(epoch_time, contact_id)
+    return get_cloudwatch_log_events(cloudwatch_log_group_name,
+                                     cloudwatch_client,
+                                     epoch_time,
+                                     contact_id)
+
+
+def stitch_lex_log_events(json_data, lex_log_events):
+    participant_ids = get_participant_ids(json_data)
+    json_data['Transcript'] = merge_transcripts(get_lex_turns(lex_log_events,
+                                                              json_data['CustomerMetadata']['ContactId'],
+                                                              participant_ids.get('CUSTOMER'),
+                                                              participant_ids.get('AGENT')),
+                                                json_data['Transcript'])
+    return json_data
+
+
+def get_lex_turns(lex_log_events, contact_id, customer_id, agent_id):
+    # Each Amazon Lex Conversation Log holds the customer input followed by the bot responses to it. Log events are
+    # ordered by time, so the turns come out in conversation order, each tagged with the time of its log event.
+    lex_turns = []
+    for timestamp, lex_log in lex_log_events:
         lex_json = json.loads(lex_log)
-        if 'messages' in lex_json:
-            lex_json['messages'].reverse()
-            for bot_prompt in lex_json['messages']:
-                json_data['Transcript'].insert(0, get_transcript(bot_prompt.get('content'), agent_id))
         if 'inputTranscript' in lex_json:
-            json_data['Transcript'].insert(0, get_transcript(lex_json['inputTranscript'], customer_id))
-    return json_data, found_match
+            lex_turns.append((timestamp, get_transcript(lex_json['inputTranscript'],
+                                                        customer_id,
+                                                        get_lex_transcript_id(contact_id, len(lex_turns)))))
+        for bot_prompt in lex_json.get('messages') or []:
+            lex_turns.append((timestamp, get_transcript(bot_prompt.get('content'),
+                                                        agent_id,
+                                                        get_lex_transcript_id(contact_id, len(lex_turns)))))
+    return lex_turns
+
+
+def get_lex_transcript_id(contact_id, turn_index):
+    # Derive the ID of an Amazon Lex turn from the contact and its position, so stitching the same contact again
+    # produces exactly the same output, whatever order contacts are processed in.
+    return str(uuid.uuid5(LEX_TRANSCRIPT_NAMESPACE, '{}/{}'.format(contact_id, turn_index)))
+
+
+def get_contact_lens_turn_times(transcripts):
+    # Contact Lens chat transcripts carry the absolute time of every turn. Voice transcripts only carry offsets from
+    # the start of the recording, which cannot be lined up with Amazon Lex log timestamps, so return None for them.
+    turn_times = []
+    for transcript in transcripts:
+        absolute_time = transcript.get('AbsoluteTime')
+        if not absolute_time:
+            return None
+        try:
+            turn_times.append(int(parser.isoparse(absolute_time).timestamp() * 1000))
+        except ValueError:
+            return None
+    return turn_times
+
+
+def merge_transcripts(lex_turns, transcripts):
+    contact_lens_turn_times = get_contact_lens_turn_times(transcripts)
+    if not lex_turns or contact_lens_turn_times is None:
+        # Without timing information the Amazon Lex part of the conversation is placed before the Contact Lens part.
+        return [transcript for timestamp, transcript in lex_turns] + transcripts
+
+    # Interleave both (already time ordered) sequences in a single pass. On equal timestamps the Amazon Lex turn goes
+    # first, since the bot handles the contact before it is routed onwards.
+    merged = []
+    lex_index = 0
+    contact_lens_index = 0
+    while lex_index < len(lex_turns) and contact_lens_index < len(transcripts):
+        if lex_turns[lex_index][0] <= contact_lens_turn_times[contact_lens_index]:
+            merged.append(lex_turns[lex_index][1])
+            lex_index = lex_index + 1
+        else:
+            merged.append(transcripts[contact_lens_index])
+            contact_lens_index = contact_lens_index + 1
+    merged.extend(transcript for timestamp, transcript in lex_turns[lex_index:])
+    merged.extend(transcripts[contact_lens_index:])
+    return merged
+
+
+def get_conversation_epoch_time(file_name):
+    # Contact Lens file names end with the conversation timestamp, e.g. <contact ID>_analysis_2021-05-03T18:21:23Z.json
+    conversation_timestamp = file_name[(len(file_name) - 25):(len(file_name) - 5)]
+    utc_time = parser.parse(conversation_timestamp)
+    return int(utc_time.timestamp() * 1000)
+
 
+def get_conversation_epoch_times(s3_objects):
+    epoch_times = []
+    for s3_object in s3_objects:
+        if s3_object.get('Key').endswith('.json'):
+            try:
+                epoch_times.append(get_conversation_epoch_time(s3_object.get('Key')))
+            except ValueError:
+                # Keys without a conversation timestamp fail later on when they are stitched.
+                continue
+    return epoch_times
 
-def get_transcript(lex_transcript, participant_id):
+
+def get_transcript(lex_transcript, participant_id, transcript_id=None):
     return {'ParticipantId': participant_id,
-            'Id': str(uuid.uuid4()),
+            'Id': transcript_id or str(uuid.uuid4()),
             'Content': lex_transcript}
 
 
-def get_participant_id(json_data, participant_type):
+def get_participant_ids(json_data):
+    # Map every participant role to the first participant ID with that role, in a single scan.
+    participant_ids = dict()
     for participant in json_data['Participants']:
-        if participant_type == participant['ParticipantRole']:
-            return participant['ParticipantId']
+        participant_ids.setdefault(participant['ParticipantRole'], participant['ParticipantId'])
+    return participant_ids
 
 
-def get_cloudwatch_logs(cloudwatch_log_group_name, cloudwatch_client, epoch_time, contact_id):
+def get_cloudwatch_log_events(cloudwatch_log_group_name, cloudwatch_client, epoch_time, contact_id):
     next_token = None
     more_results = True
     lex_logs = []
@@ -179,7 +528,7 @@ def get_cloudwatch_logs(cloudwatch_log_group_name, cloudwatch_client, epoch_time
 
         # For each matching Amazon CloudWatch Log Entry, fetch the message part of the Conversation Logs.
         for event in response.get('events'):
-            lex_logs.append(event.get('message'))
+            lex_logs.append((event.get('timestamp'), event.get('message')))
 
         # If there are more results, continue pagination.
         if response.get('nextToken') is None:
@@ -187,6 +536,9 @@ def get_cloudwatch_logs(cloudwatch_log_group_name, cloudwatch_client, epoch_time
         else:
             next_token = response.get('nextToken')
 
+    # Keep the events in time order even when they were interleaved from several log streams.
+    lex_logs.sort(key=lambda event: event[0])
+
     if len(lex_logs) > 0:
         found_match = True
 
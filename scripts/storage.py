@@ -0,0 +1,228 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import datetime
+import os
+import tempfile
+
+S3_URI_PREFIX = 's3://'
+FILE_URI_PREFIX = 'file://'
+PAGE_SIZE = 1000
+DELETE_BATCH_SIZE = 1000
+
+
+def get_new_file_mode():
+    # The permissions an ordinary new file gets under the process umask. Reading the umask means setting it, so this
+    # runs once at import time, before any worker threads exist.
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+# tempfile.mkstemp creates files only their owner can read, so files written through it get these permissions instead.
+NEW_FILE_MODE = get_new_file_mode()
+
+
+def parse_location(location):
+    # Locations are either Amazon S3 buckets (a plain bucket name, or s3://bucket/prefix) or local directories
+    # (file:///path, or anything that looks like a path). Bucket names can never contain a path separator.
+    if location.startswith(S3_URI_PREFIX):
+        bucket, _, prefix = location[len(S3_URI_PREFIX):].partition('/')
+        return 's3', bucket, prefix
+    if location.startswith(FILE_URI_PREFIX):
+        return 'local', location[len(FILE_URI_PREFIX):], ''
+    if '/' in location or os.sep in location or location.startswith('.'):
+        return 'local', location, ''
+    return 's3', location, ''
+
+
+def create_s3_client(access_key=None, secret_key=None, region=None, max_pool_connections=None, api_guard=None):
+    # Only import the AWS SDK when Amazon S3 is actually used, so local runs do not depend on it.
+    import boto3
+    from botocore.config import Config
+
+    config_arguments = dict()
+    if max_pool_connections:
+        config_arguments['max_pool_connections'] = max_pool_connections
+    if api_guard is not None:
+        config_arguments['retries'] = api_guard.sdk_retries
+    s3_client = boto3.client('s3',
+                             aws_access_key_id=access_key,
+                             aws_secret_access_key=secret_key,
+                             region_name=region,
+                             config=Config(**config_arguments) if config_arguments else None)
+    return api_guard.attach(s3_client) if api_guard is not None else s3_client
+
+
+def get_storage(location, access_key=None, secret_key=None, region=None, max_pool_connections=None, s3_client=None,
+                api_guard=None):
+    # Return the storage backend for a location, together with the key prefix the location points at.
+    kind, container, prefix = parse_location(location)
+    if kind == 'local':
+        return LocalStorage(container), prefix
+    if s3_client is None:
+        s3_client = create_s3_client(access_key, secret_key, region, max_pool_connections, api_guard)
+    return S3Storage(s3_client, container), prefix
+
+
+class S3Storage:
+    def __init__(self, s3_client, bucket):
+        self.s3_client = s3_client
+        self.bucket = bucket
+
+    def list_pages(self, prefix=None, start_after=None):
+        more_keys_left = True
+        continuation_token = None
+        list_arguments = {'Bucket': self.bucket}
+        if prefix:
+            list_arguments['Prefix'] = prefix
+        if start_after:
+            list_arguments['StartAfter'] = start_after
+
+        # Call Amazon S3 ListObjects to fetch all the keys in the bucket, one page at a time.
+        while more_keys_left:
+            if continuation_token:
+                s3_objects = self.s3_client.list_objects_v2(ContinuationToken=continuation_token, **list_arguments)
+            else:
+                s3_objects = self.s3_client.list_objects_v2(**list_arguments)
+
+            yield s3_objects.get('Contents', [])
+
+            # If more results are available, continue pagination.
+            if s3_objects.get('IsTruncated'):
+                continuation_token = s3_objects.get('NextContinuationToken')
+            else:
+                more_keys_left = False
+
+    def list_prefixes(self, prefix=None):
+        # List one level below the prefix: the objects directly under it and the '/'-terminated sub-prefixes.
+        listed_objects = []
+        sub_prefixes = []
+        list_arguments = {'Bucket': self.bucket, 'Delimiter': '/'}
+        if prefix:
+            list_arguments['Prefix'] = prefix
+        while True:
+            s3_objects = self.s3_client.list_objects_v2(**list_arguments)
+            listed_objects.extend(s3_objects.get('Contents', []))
+            sub_prefixes.extend(common_prefix.get('Prefix') for common_prefix in s3_objects.get('CommonPrefixes', []))
+            if not s3_objects.get('IsTruncated'):
+                return listed_objects, sub_prefixes
+            list_arguments['ContinuationToken'] = s3_objects.get('NextContinuationToken')
+
+    def get(self, key):
+        s3_file = self.s3_client.get_object(Bucket=self.bucket, Key=key)
+        return s3_file.get('Body').read()
+
+    def open(self, key):
+        # The response body as a stream, for readers that parse it as it arrives.
+        return self.s3_client.get_object(Bucket=self.bucket, Key=key).get('Body')
+
+    def put(self, key, body):
+        self.s3_client.put_object(Bucket=self.bucket, Key=key, Body=body)
+
+    def delete(self, keys):
+        # DeleteObjects takes up to 1000 keys per request.
+        for index in range(0, len(keys), DELETE_BATCH_SIZE):
+            self.s3_client.delete_objects(Bucket=self.bucket,
+                                          Delete={'Objects': [{'Key': key}
+                                                              for key in keys[index:index + DELETE_BATCH_SIZE]],
+                                                  'Quiet': True})
+
+
+class LocalStorage:
+    # Mirrors the Amazon S3 calls on a local directory. Keys are paths relative to the root directory, always separated
+    # by '/', and are listed in the same lexicographic order as Amazon S3 lists them.
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def list_pages(self, prefix=None, start_after=None):
+        keys = []
+        for directory, _, file_names in os.walk(self.root):
+            relative_directory = os.path.relpath(directory, self.root)
+            for file_name in file_names:
+                if relative_directory == '.':
+                    key = file_name
+                else:
+                    key = '/'.join(relative_directory.split(os.sep) + [file_name])
+                if prefix and not key.startswith(prefix):
+                    continue
+                if start_after and key <= start_after:
+                    continue
+                keys.append(key)
+        keys.sort()
+
+        for index in range(0, len(keys), PAGE_SIZE):
+            yield [self._describe(key) for key in keys[index:index + PAGE_SIZE]]
+
+    def list_prefixes(self, prefix=None):
+        # Directories play the part of '/'-terminated sub-prefixes.
+        parent_key, _, name_start = (prefix or '').rpartition('/')
+        parent_key = parent_key + '/' if parent_key else ''
+        listed_objects = []
+        sub_prefixes = []
+        if not os.path.isdir(self._path(parent_key)):
+            return listed_objects, sub_prefixes
+        for entry in sorted(os.scandir(self._path(parent_key)), key=lambda entry: entry.name):
+            if not entry.name.startswith(name_start):
+                continue
+            if entry.is_dir():
+                sub_prefixes.append(parent_key + entry.name + '/')
+            else:
+                listed_objects.append(self._describe(parent_key + entry.name))
+        return listed_objects, sub_prefixes
+
+    def _describe(self, key):
+        stat = os.stat(self._path(key))
+        return {'Key': key,
+                'Size': stat.st_size,
+                'LastModified': datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc),
+                # There is no content hash to hand without reading the file, so the modification time and size stand
+                # in for the ETag. They change whenever the file is rewritten.
+                'ETag': '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size)}
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as local_file:
+            return local_file.read()
+
+    def open(self, key):
+        return open(self._path(key), 'rb')
+
+    def put(self, key, body):
+        path = self._path(key)
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        # Write to a temporary file first so readers never see a partially written object.
+        file_descriptor, temporary_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        try:
+            with os.fdopen(file_descriptor, 'wb') as local_file:
+                local_file.write(body)
+            os.chmod(temporary_path, NEW_FILE_MODE)
+            os.replace(temporary_path, path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,165 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import datetime
+import json
+import uuid
+
+WORDS = ['account', 'balance', 'card', 'order', 'refund', 'delivery', 'password', 'reset', 'help', 'please', 'thanks',
+         'agent', 'payment', 'address', 'update', 'cancel', 'booking', 'flight', 'hotel', 'status', 'yes', 'no']
+BASE_TIME = datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def get_sentence(rng, min_words=3, max_words=15):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(min_words, max_words))).capitalize() + '.'
+
+
+def get_contact_id(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def get_conversation_start(rng, days=30):
+    return BASE_TIME + datetime.timedelta(seconds=rng.randint(0, days * 86400))
+
+
+def format_time(utc_time):
+    return utc_time.strftime('%Y-%m-%dT%H:%M:%S.') + '{:03d}Z'.format(utc_time.microsecond // 1000)
+
+
+def generate_connect_chat(rng, turns=20, participants=2):
+    # An Amazon Connect Chat transcript, including the system events the converter has to skip.
+    contact_id = get_contact_id(rng)
+    start = get_conversation_start(rng)
+    roles = ['CUSTOMER'] + ['AGENT'] * max(participants - 2, 1) + ['SYSTEM']
+    participant_ids = [get_contact_id(rng) for _ in roles]
+    transcript = [{'AbsoluteTime': format_time(start),
+                   'ContentType': 'application/vnd.amazonaws.connect.event.participant.joined',
+                   'Id': get_contact_id(rng),
+                   'Type': 'EVENT',
+                   'ParticipantId': participant_ids[0],
+                   'ParticipantRole': 'CUSTOMER'}]
+    for turn in range(turns):
+        index = turn % len(roles)
+        transcript.append({'AbsoluteTime': format_time(start + datetime.timedelta(seconds=5 * (turn + 1))),
+                           'Content': get_sentence(rng),
+                           'ContentType': 'text/plain',
+                           'Id': get_contact_id(rng),
+                           'Type': 'MESSAGE',
+                           'ParticipantId': participant_ids[index],
+                           'DisplayName': roles[index].title(),
+                           'ParticipantRole': roles[index]})
+    return {'Version': '2019-08-26',
+            'AWSAccountId': '123456789012',
+            'InstanceId': get_contact_id(rng),
+            'InitialContactId': contact_id,
+            'ContactId': contact_id,
+            'Participants': [{'ParticipantId': participant_id} for participant_id in participant_ids],
+            'Transcript': transcript}
+
+
+def generate_call_analytics(rng, turns=200, participants=2):
+    # An Amazon Transcribe Call Analytics transcript. Loudness, sentiment, word items and categories are included at
+    # realistic sizes even though the converter never reads them.
+    roles = ['AGENT', 'CUSTOMER'] + ['AGENT'] * max(participants - 2, 0)
+    transcript = []
+    offset = 0
+    for turn in range(turns):
+        content = get_sentence(rng)
+        duration = 500 * len(content.split())
+        transcript.append({'Id': get_contact_id(rng),
+                           'BeginOffsetMillis': offset,
+                           'EndOffsetMillis': offset + duration,
+                           'Content': content,
+                           'ParticipantRole': roles[turn % 2],
+                           'Sentiment': rng.choice(['POSITIVE', 'NEUTRAL', 'NEGATIVE', 'MIXED']),
+                           'LoudnessScores': [round(rng.uniform(40, 90), 2) for _ in range(duration // 1000 + 1)],
+                           'Items': [{'BeginOffsetMillis': offset + 500 * index,
+                                      'EndOffsetMillis': offset + 500 * (index + 1),
+                                      'Content': word,
+                                      'Confidence': round(rng.random(), 4),
+                                      'Type': 'pronunciation'} for index, word in enumerate(content.split())]})
+        offset = offset + duration + 300
+    return {'JobName': 'job-' + get_contact_id(rng),
+            'LanguageCode': 'en-US',
+            'AccountId': '123456789012',
+            'Channel': 'VOICE',
+            'ContentMetadata': {'Output': 'Raw'},
+            'Participants': [{'ParticipantRole': role} for role in roles[:max(participants, 2)]],
+            'Categories': {'MatchedCategories': [], 'MatchedDetails': {}},
+            'ConversationCharacteristics': {'TotalConversationDurationMillis': offset,
+                                            'Sentiment': {'OverallSentiment': {'AGENT': 1.2, 'CUSTOMER': 0.4}},
+                                            'Interruptions': {'TotalCount': 0},
+                                            'NonTalkTime': {'TotalTimeMillis': 0}},
+            'Transcript': transcript}
+
+
+def generate_contact_lens(rng, turns=20, lex_turns=4, bot_messages=1, chat=True):
+    # A Contact Lens transcript, its object key and the matching Amazon Lex Conversation Log events that happened
+    # right before the contact reached the agent.
+    contact_id = get_contact_id(rng)
+    start = get_conversation_start(rng)
+    agent_start = start + datetime.timedelta(seconds=10 * (lex_turns + 1))
+    contact_lens_transcript = []
+    for turn in range(turns):
+        transcript = {'ParticipantId': 'AGENT' if turn % 2 == 0 else 'CUSTOMER',
+                      'Id': get_contact_id(rng),
+                      'Content': get_sentence(rng)}
+        if chat:
+            transcript['AbsoluteTime'] = format_time(agent_start + datetime.timedelta(seconds=5 * turn))
+        else:
+            transcript['BeginOffsetMillis'] = 5000 * turn
+            transcript['EndOffsetMillis'] = 5000 * turn + 4000
+        contact_lens_transcript.append(transcript)
+
+    contact_lens_json = {'Version': '1.1.0',
+                         'AccountId': '123456789012',
+                         'Channel': 'CHAT' if chat else 'VOICE',
+                         'ContentMetadata': {'Output': 'Raw', 'RedactionTypes': None},
+                         'CustomerMetadata': {'ContactId': contact_id},
+                         'Participants': [{'ParticipantId': 'AGENT', 'ParticipantRole': 'AGENT'},
+                                          {'ParticipantId': 'CUSTOMER', 'ParticipantRole': 'CUSTOMER'}],
+                         'Transcript': contact_lens_transcript}
+    key = 'Analysis/{}/{}/{}_analysis_{}.json'.format('Chat' if chat else 'Voice',
+                                                      start.strftime('%Y/%m/%d'),
+                                                      contact_id,
+                                                      start.strftime('%Y-%m-%dT%H:%M:%SZ'))
+    return key, contact_lens_json, generate_lex_conversation_logs(rng, contact_id, start, lex_turns, bot_messages)
+
+
+def generate_lex_conversation_logs(rng, session_id, start, turns=4, bot_messages=1):
+    # Amazon Lex V2 Conversation Log events, as (epoch milliseconds, message) pairs.
+    events = []
+    for turn in range(turns):
+        timestamp = start + datetime.timedelta(seconds=10 * turn)
+        message = {'sessionId': session_id,
+                   'requestId': get_contact_id(rng),
+                   'inputMode': 'Text',
+                   'inputTranscript': get_sentence(rng),
+                   'messages': [{'contentType': 'PlainText', 'content': get_sentence(rng)}
+                                for _ in range(bot_messages)],
+                   'interpretations': [{'intent': {'name': 'FallbackIntent', 'state': 'InProgress'}}],
+                   'bot': {'name': 'SyntheticBot', 'version': 'DRAFT', 'localeId': 'en_US'}}
+        events.append((int(timestamp.timestamp() * 1000), json.dumps(message)))
+    return events
+
+
+def format_export_lines(events):
+    # The line format of an Amazon CloudWatch Logs export to Amazon S3.
+    return ''.join('{} {}\n'.format(format_time(datetime.datetime.fromtimestamp(timestamp / 1000,
+                                                                                 datetime.timezone.utc)), message)
+                   for timestamp, message in events)
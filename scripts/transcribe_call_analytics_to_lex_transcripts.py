@@ -18,25 +18,39 @@
 
 import argparse
 import datetime
-import json
+import functools
 import random
 import sys
+import time
 import uuid
+from concurrent.futures import ProcessPoolExecutor
 
-import boto3
+from api_guard import DEFAULT_MAX_ATTEMPTS, ApiGuard, parse_rate_limit
+from dedup import ContentDeduplicator, get_transcript_fingerprint
+from json_codec import DEFAULT_JSON_CODEC, JSON_CODECS, get_json_codec
+from key_discovery import DEFAULT_LISTING_DEPTH, DEFAULT_LISTING_SPLIT, LISTING_SPLITS, get_key_source
+from key_filter import add_key_filter_arguments, get_key_filter
+from manifest import Manifest
+from metrics import DEFAULT_METRICS_FORMAT, METRICS_FORMATS, InstrumentedStorage, Metrics
+from output_sink import DEFAULT_OUTPUT_COMPRESSION, OUTPUT_COMPRESSIONS, get_output_sink
+from pipeline import DEFAULT_CONCURRENCY, DeadLetterFile, TransformPipeline, list_json_objects
+from sharding import get_shard_location, get_shard_tag
+from selective_json import CALL_ANALYTICS_FIELDS, get_selective_parser, load_fields
+from storage import get_storage
+from turn_export import DEFAULT_TURN_EXPORT_FORMAT, DEFAULT_TURN_EXPORT_ROWS, TURN_EXPORT_FORMATS, TurnExportSink, get_turns
 
 
-def get_random_time():
+def get_random_time(rng=random):
     TIME_STRING_FORMAT = '%02d:%02d:%02d'
     # Generate a random number scaled to the number of seconds in a day    
-    time = int(random.random() * 86400)
+    time = int(rng.random() * 86400)
     hours = int(time / 3600)
     minutes = int((time - hours * 3600) / 60)
     seconds = time - hours * 3600 - minutes * 60
     return TIME_STRING_FORMAT % (hours, minutes, seconds)
 
 
-def convert_to_contact_lens_format(call_analytics_json):
+def convert_to_contact_lens_format(call_analytics_json, content_keys=False, conversation_time=None):
     cur_json = dict()
     cur_json['ContentMetadata'] = call_analytics_json['ContentMetadata']
     if 'RedactionTypes' not in cur_json['ContentMetadata']:
@@ -65,24 +79,139 @@ def convert_to_contact_lens_format(call_analytics_json):
         cur_transcript['Content'] = transcript['Content']
         cur_transcript['ParticipantId'] = participant_role_to_id[transcript['ParticipantRole']]
         cur_json['Transcript'].append(cur_transcript)
+
     today = datetime.date.today()
-    file_name = '{}_analysis_{}_T{}Z.json'.format(cur_str, today.strftime('%Y-%m-%d'), get_random_time())
+    date_string = today.strftime('%Y-%m-%d')
+    time_string = None
+    file_prefix = cur_str
+    if content_keys:
+        # Derive the contact ID and the output file name from the transcript content instead of at random, so
+        # converting the same transcript again overwrites the same object instead of creating a new one. The file
+        # name carries the given conversation time (e.g. when the source object was written), if there is one.
+        rng = random.Random(get_transcript_fingerprint(cur_json))
+        cur_str = str(int(rng.random() * 10000))
+        cur_uuid = uuid.UUID(int=rng.getrandbits(128), version=4)
+        cur_json['CustomerMetadata']['ContactId'] = '{}-{}'.format(cur_str, cur_uuid)
+        # Name the file after the whole contact ID, since many sources share the same last-modified second and the
+        # short number alone would let different transcripts overwrite each other.
+        file_prefix = cur_json['CustomerMetadata']['ContactId']
+        if conversation_time is not None:
+            utc_time = conversation_time.astimezone(datetime.timezone.utc)
+            date_string = utc_time.strftime('%Y-%m-%d')
+            time_string = utc_time.strftime('%H:%M:%S')
+        else:
+            time_string = get_random_time(rng)
+    file_name = '{}_analysis_{}_T{}Z.json'.format(file_prefix, date_string, time_string or get_random_time())
     return file_name, cur_json
 
 
+def transform_transcript(s3_object, call_analytics_json, json_codec_name=DEFAULT_JSON_CODEC, content_keys=False,
+                         selective_parse=False, export_turns=False):
+    # Decode, transform to the Contact Lens format and encode again, working on bytes throughout. This may run in a
+    # worker process, so the time each step took, the content fingerprint and, when exported, the turns are handed
+    # back with the result.
+    json_codec = get_json_codec(json_codec_name)
+    start = time.perf_counter()
+    if selective_parse:
+        # Only pull the fields the conversion reads, from the body or straight from the response stream.
+        json_data = load_fields(call_analytics_json, CALL_ANALYTICS_FIELDS)
+    else:
+        json_data = json_codec.loads(call_analytics_json)
+    parsed = time.perf_counter()
+    file_name, contact_lens_json = convert_to_contact_lens_format(json_data, content_keys,
+                                                                  s3_object.get('LastModified'))
+    fingerprint = get_transcript_fingerprint(contact_lens_json)
+    transformed = time.perf_counter()
+    contact_lens_body = json_codec.dumps(contact_lens_json)
+    stage_seconds = {'parse': parsed - start,
+                     'transform': transformed - parsed,
+                     'serialize': time.perf_counter() - transformed}
+    turns = get_turns(contact_lens_json, s3_object.get('Key')) if export_turns else None
+    return file_name, contact_lens_body, stage_seconds, fingerprint, turns
+
+
 def main():
     arg_parser = argparse.ArgumentParser(description='Read Amazon Transcribe Call Analytics transcripts from a configured Amazon S3 '
                                                      'bucket, convert them into the Amazon Lex/Contact Lens transcript format  '
                                                      'and, upload them into a different Amazon S3 bucket.')
-    arg_parser.add_argument('--source', required=True, type=str, help="Set the source Amazon S3 bucket containing Amazon Transcribe "
+    arg_parser.add_argument('--source', required=True, type=str, help="Set the source Amazon S3 bucket (or local directory) containing Amazon Transcribe "
                                                                       "Call Analytics transcripts")
-    arg_parser.add_argument('--target', required=True, type=str, help="Set the target Amazon S3 bucket to upload the Amazon Lex "
+    arg_parser.add_argument('--target', required=True, type=str, help="Set the target Amazon S3 bucket (or local directory) to upload the Amazon Lex "
                                                                       "transcripts")
     arg_parser.add_argument('--access_key', required=False, type=str,
                             help="Access key of the credentials needed to query Amazon S3")
     arg_parser.add_argument('--secret_key', required=False, type=str,
                             help="Secret key of the credentials needed to query Amazon S3")
-    arg_parser.add_argument('--region', required=True, help="Specify the region. This flag is required")
+    arg_parser.add_argument('--region', required=False, help="Specify the region. This flag is required when the source "
+                                                             "or target is an Amazon S3 bucket")
+    arg_parser.add_argument('--concurrency', required=False, type=int, default=DEFAULT_CONCURRENCY,
+                            help="Number of keys downloaded and uploaded in parallel (default: %(default)s)")
+    arg_parser.add_argument('--manifest', required=False, type=str,
+                            help="Local file or s3://bucket/prefix location of the manifest of processed keys. Unchanged "
+                                 "keys are skipped and an interrupted run resumes after its last completed page")
+    arg_parser.add_argument('--transform_processes', required=False, type=int, default=0,
+                            help="Number of worker processes that decode, convert and encode transcripts. By default "
+                                 "this happens on the download threads")
+    arg_parser.add_argument('--json_codec', required=False, choices=JSON_CODECS, default=DEFAULT_JSON_CODEC,
+                            help="JSON library used to decode and encode transcripts (default: %(default)s)")
+    arg_parser.add_argument('--output_compression', required=False, choices=OUTPUT_COMPRESSIONS,
+                            default=DEFAULT_OUTPUT_COMPRESSION,
+                            help="Compression of the uploaded transcripts. Gzipped objects get a .gz suffix "
+                                 "(default: %(default)s)")
+    arg_parser.add_argument('--pack_size', required=False, type=int, default=0,
+                            help="Upload transcripts in packs of this many, as one JSON lines object with an index "
+                                 "object next to it, instead of one object per transcript")
+    arg_parser.add_argument('--inventory', required=False, type=str,
+                            help="Local path or s3:// URI of the manifest.json of an Amazon S3 Inventory report of the "
+                                 "source bucket. Keys are read from the report instead of being listed")
+    arg_parser.add_argument('--listing_concurrency', required=False, type=int, default=1,
+                            help="Number of key ranges of the source listed in parallel (default: %(default)s)")
+    arg_parser.add_argument('--listing_split', required=False, choices=LISTING_SPLITS, default=DEFAULT_LISTING_SPLIT,
+                            help="Split the parallel listing by '/'-separated sub-prefixes, such as dates, or by the "
+                                 "first character after the prefix (default: %(default)s)")
+    arg_parser.add_argument('--listing_depth', required=False, type=int, default=DEFAULT_LISTING_DEPTH,
+                            help="Number of '/'-separated levels a prefix split descends (default: %(default)s)")
+    arg_parser.add_argument('--metrics_file', required=False, type=str,
+                            help="Write run metrics (stage timers and latency histograms, API call, retry and throttle "
+                                 "counts, bytes and items per second) to this file")
+    arg_parser.add_argument('--metrics_format', required=False, choices=METRICS_FORMATS, default=DEFAULT_METRICS_FORMAT,
+                            help="Format of the metrics file (default: %(default)s)")
+    arg_parser.add_argument('--metrics_interval', required=False, type=float, default=0,
+                            help="Print a metrics progress line, and refresh the metrics file, every this many seconds")
+    arg_parser.add_argument('--deduplicate', required=False, action='store_true',
+                            help="Skip transcripts whose content (who said what, in order) was already uploaded, in "
+                                 "this run or, with --manifest, in earlier runs")
+    arg_parser.add_argument('--content_keys', required=False, action='store_true',
+                            help="Derive the contact ID and output file name from the transcript content and the "
+                                 "source object's time instead of at random, so re-runs overwrite the same objects")
+    arg_parser.add_argument('--selective_parse', required=False, action='store_true',
+                            help="Parse only the transcript fields the conversion reads, streaming them from the "
+                                 "source when ijson is installed, to bound the memory each worker needs")
+    add_key_filter_arguments(arg_parser)
+    arg_parser.add_argument('--max_attempts', required=False, type=int, default=DEFAULT_MAX_ATTEMPTS,
+                            help="Attempts per AWS API call before it fails. Throttling, server and connection errors "
+                                 "are retried with jittered exponential backoff (default: %(default)s)")
+    arg_parser.add_argument('--rate_limit', required=False, type=parse_rate_limit, action='append',
+                            help="Cap an AWS API operation at a number of requests per second, as OPERATION=RATE, "
+                                 "such as GetObject=3000. Can be given several times")
+    arg_parser.add_argument('--dead_letter_file', required=False, type=str,
+                            help="Append every key that fails, with its ETag and the error, to this JSON lines file")
+    arg_parser.add_argument('--shard_index', required=False, type=int, default=0,
+                            help="Process only the keys of this shard, numbered from 0 (default: %(default)s)")
+    arg_parser.add_argument('--shard_count', required=False, type=int, default=1,
+                            help="Split the keys into this many shards by a stable hash of the key, so several nodes "
+                                 "can each process one shard of the same source (default: %(default)s)")
+    arg_parser.add_argument('--turn_export', required=False, type=str,
+                            help="Also write every transcript turn (contact ID, turn index, participant role, content, "
+                                 "whether it came from Amazon Lex and source key) to large files partitioned by "
+                                 "conversation date under this Amazon S3 bucket/prefix or local directory")
+    arg_parser.add_argument('--turn_export_format', required=False, choices=TURN_EXPORT_FORMATS,
+                            default=DEFAULT_TURN_EXPORT_FORMAT,
+                            help="Format of the turn export files: gzipped JSON lines, or Parquet, which requires "
+                                 "pyarrow (default: %(default)s)")
+    arg_parser.add_argument('--turn_export_rows', required=False, type=int, default=DEFAULT_TURN_EXPORT_ROWS,
+                            help="Number of turns buffered before the turn export files are written "
+                                 "(default: %(default)s)")
 
     arg = arg_parser.parse_args()
     source = arg.source
@@ -90,50 +219,159 @@ def main():
     access_key = arg.access_key
     secret_key = arg.secret_key
     region = arg.region
+    concurrency = arg.concurrency
+    manifest_location = arg.manifest
+    transform_processes = arg.transform_processes
+    json_codec_name = arg.json_codec
+    output_compression = arg.output_compression
+    pack_size = arg.pack_size
+    inventory = arg.inventory
+    listing_concurrency = arg.listing_concurrency
+    listing_split = arg.listing_split
+    listing_depth = arg.listing_depth
+    metrics_file = arg.metrics_file
+    metrics_format = arg.metrics_format
+    metrics_interval = arg.metrics_interval
+    deduplicate = arg.deduplicate
+    content_keys = arg.content_keys
+    selective_parse = arg.selective_parse
+    max_attempts = arg.max_attempts
+    rate_limits = dict(arg.rate_limit or [])
+    dead_letter_file = arg.dead_letter_file
+    shard_index = arg.shard_index
+    shard_count = arg.shard_count
+    turn_export = arg.turn_export
+    turn_export_format = arg.turn_export_format
+    turn_export_rows = arg.turn_export_rows
+    if shard_count < 1 or not 0 <= shard_index < shard_count:
+        arg_parser.error('--shard_index must be between 0 and --shard_count - 1')
+    shard_tag = get_shard_tag(shard_index, shard_count) if shard_count > 1 else None
+    if shard_tag:
+        # Every shard keeps its own manifest, metrics and dead-letter file, which merge_shards.py combines.
+        print('[IN PROGRESS] Processing {0}'.format(shard_tag))
+        manifest_location = get_shard_location(manifest_location, shard_index, shard_count)
+        metrics_file = get_shard_location(metrics_file, shard_index, shard_count)
+        dead_letter_file = get_shard_location(dead_letter_file, shard_index, shard_count)
 
-    s3_client = boto3.client('s3',
-                             aws_access_key_id=access_key,
-                             aws_secret_access_key=secret_key,
-                             region_name=region)
+    # Time every listing page, download and upload, and count API calls and bytes along the way.
+    metrics = Metrics()
+    # Every AWS API call of the run goes through one guard, which rate limits, adapts concurrency and retries.
+    api_guard = ApiGuard(concurrency * 2, rate_limits, max_attempts)
+    dead_letter = DeadLetterFile(dead_letter_file) if dead_letter_file else None
+    source_storage, source_prefix = get_storage(source, access_key, secret_key, region,
+                                                max_pool_connections=concurrency * 2, api_guard=api_guard)
+    source_storage = InstrumentedStorage(source_storage, metrics)
+    target_storage, target_prefix = get_storage(target, access_key, secret_key, region,
+                                                max_pool_connections=concurrency * 2, api_guard=api_guard)
+    target_storage = InstrumentedStorage(target_storage, metrics)
 
-    more_keys_left = True
-    continuation_token = None
-    processed_keys = 0
+    manifest = None
+    if manifest_location:
+        manifest = Manifest(manifest_location, access_key, secret_key, region, api_guard, metrics)
+        if manifest.resume_after:
+            print('[IN PROGRESS] Resuming after key [{0}]'.format(manifest.resume_after))
+    output_sink = get_output_sink(target_storage, target_prefix, output_compression, pack_size, manifest,
+                                  shard_tag)
+    if turn_export:
+        turn_export_storage, turn_export_prefix = get_storage(turn_export, access_key, secret_key, region,
+                                                              max_pool_connections=concurrency * 2,
+                                                              api_guard=api_guard)
+        output_sink = TurnExportSink(output_sink, InstrumentedStorage(turn_export_storage, metrics),
+                                     turn_export_prefix, turn_export_format, turn_export_rows, shard_tag)
+    deduplicator = ContentDeduplicator(manifest) if deduplicate else None
 
-    # Call Amazon S3 ListObjects to fetch all the keys in the bucket.
-    while more_keys_left:
-        if continuation_token:
-            s3_objects = s3_client.list_objects_v2(Bucket=source,
-                                                   ContinuationToken=continuation_token)
-        else:
-            s3_objects = s3_client.list_objects_v2(Bucket=source)
+    # Worker processes cannot be handed a stream, so they get the body and select fields from that instead.
+    stream_source = selective_parse and transform_processes == 0
 
-        # For each Amazon S3 object, attempt performing the transformation.
-        for s3_object in s3_objects.get('Contents'):
-            if s3_object.get('Key').endswith('.json'):
-                # Retrieve the object and read the file.
-                s3_file = s3_client.get_object(Bucket=source,
-                                               Key=s3_object.get('Key'))
-                call_analytics_json = s3_file.get('Body').read().decode('utf-8')
+    def fetch(s3_object):
+        # Retrieve the object and read the file, or open it to be parsed as it arrives.
+        if stream_source:
+            return source_storage.open(s3_object.get('Key'))
+        return source_storage.get(s3_object.get('Key'))
 
-                # Transform the file to the Contact Lens format.
-                file_name, contact_lens_json = convert_to_contact_lens_format(json.loads(call_analytics_json))
+    def upload(s3_object, result):
+        # Upload the object into the target location, unless the same conversation was uploaded before.
+        file_name, contact_lens_body, stage_seconds, fingerprint, turns = result
+        for stage, seconds in stage_seconds.items():
+            metrics.observe(stage, seconds)
+        if deduplicator is not None and not deduplicator.claim(fingerprint):
+            if manifest is not None:
+                # Remember the duplicate too, so later runs do not download it again.
+                manifest.record(s3_object.get('Key'), s3_object.get('ETag'), None, fingerprint)
+            return
+        try:
+            output_sink.write(s3_object, file_name, contact_lens_body, fingerprint)
+        except Exception:
+            if deduplicator is not None:
+                # Let a later copy of this conversation be uploaded instead.
+                deduplicator.release(fingerprint)
+            raise
+        if turns is not None:
+            # The transcript is uploaded and keeps its claim even if exporting its turns fails, which is reported as a
+            # TurnExportError rather than as a failed upload.
+            output_sink.export(file_name, turns)
 
-                # Upload the object back into the original bucket under a new path.
-                s3_client.put_object(Bucket=target,
-                                     Key=file_name,
-                                     Body=bytes(json.dumps(contact_lens_json).encode('UTF-8')))
+    def report_progress(page):
+        if page:
+            output_sink.checkpoint(page[-1].get('Key'))
+        print('[IN PROGRESS] Successfully transformed [{0}] keys'.format(pipeline.processed_keys))
 
-                processed_keys = processed_keys + 1
+    # List, download, transform and upload concurrently, with at most a bounded number of keys in flight.
+    transform_executor = None
+    if transform_processes > 0:
+        # Decoding, converting and encoding are CPU bound, so spread them over several processes.
+        transform_executor = ProcessPoolExecutor(max_workers=transform_processes)
+    pipeline = TransformPipeline(fetch,
+                                 functools.partial(transform_transcript, json_codec_name=json_codec_name,
+                                                   content_keys=content_keys, selective_parse=selective_parse,
+                                                   export_turns=bool(turn_export)),
+                                 upload,
+                                 concurrency=concurrency,
+                                 transform_executor=transform_executor,
+                                 metrics=metrics,
+                                 dead_letter=dead_letter)
+    key_source = get_key_source(source_storage, inventory, listing_concurrency, listing_split, listing_depth,
+                                access_key, secret_key, region, api_guard, metrics)
+    pages = list_json_objects(key_source, source_prefix, start_after=manifest.resume_after if manifest else None)
+    if selective_parse:
+        print('[IN PROGRESS] Parsing selected transcript fields with the {0} parser'.format(get_selective_parser()))
+    key_filter = get_key_filter(arg)
+    if key_filter.is_active():
+        # Select keys on their listing metadata and names alone, so nothing outside the selection is downloaded.
+        pages = key_filter.filter_pages(pages)
+    if manifest is not None:
+        pages = manifest.filter_pages(pages)
+    if metrics_interval > 0:
+        metrics.start_reporting(metrics_interval, metrics_file, metrics_format)
+    try:
+        processed_keys, failed_keys = pipeline.run(pages, on_page_done=report_progress)
+        output_sink.close()
+    finally:
+        if transform_executor is not None:
+            transform_executor.shutdown()
+        metrics.stop_reporting()
 
-        # If more results are available, continue pagination.
-        if s3_objects.get('IsTruncated'):
-            continuation_token = s3_objects.get('NextContinuationToken')
-        else:
-            more_keys_left = False
+    print(metrics.get_progress_line())
+    if metrics_file:
+        metrics.write(metrics_file, metrics_format)
+
+    if manifest is not None:
+        manifest.complete()
+        print('[COMPLETE] Skipped [{0}] unchanged keys'.format(manifest.skipped_keys))
+    if key_filter.is_active():
+        print('[COMPLETE] Skipped [{0}] keys outside the selection'.format(key_filter.filtered_keys))
+    if deduplicator is not None:
+        print('[COMPLETE] Skipped [{0}] duplicate transcripts'.format(deduplicator.duplicate_keys))
+    if turn_export:
+        print('[COMPLETE] Exported [{0}] turns in [{1}] files'.format(output_sink.exported_turns, output_sink.files))
 
-        print('[IN PROGRESS] Successfully transformed [{0}] keys'.format(processed_keys))
+    if dead_letter is not None and dead_letter.dead_keys:
+        print('[COMPLETE] Wrote [{0}] failed keys to [{1}]'.format(dead_letter.dead_keys, dead_letter_file))
 
+    if failed_keys:
+        print('[COMPLETE] Successfully transformed [{0}] keys, failed to transform [{1}] keys'.format(processed_keys,
+                                                                                                   failed_keys))
+        return 1
     print('[COMPLETE] Successfully transformed [{0}] keys'.format(processed_keys))
 
 
@@ -0,0 +1,194 @@
+"""
+  Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+  SPDX-License-Identifier: MIT-0
+
+  Permission is hereby granted, free of charge, to any person obtaining a copy of this
+  software and associated documentation files (the "Software"), to deal in the Software
+  without restriction, including without limitation the rights to use, copy, modify,
+  merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+  permit persons to whom the Software is furnished to do so.
+
+  THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+  INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+  PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+  HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+  OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+  SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+ """
+
+import io
+import json
+import threading
+import time
+
+from key_filter import get_key_time
+from output_sink import compress
+
+TURN_EXPORT_FORMATS = ['jsonl', 'parquet']
+DEFAULT_TURN_EXPORT_FORMAT = 'jsonl'
+DEFAULT_TURN_EXPORT_ROWS = 250000
+TURN_COLUMNS = ['contact_id', 'turn_index', 'participant_role', 'content', 'from_lex', 'source_key']
+# Turns of contacts whose key carries no conversation time still need a partition.
+UNKNOWN_DATE = 'unknown'
+
+
+def get_turns(contact_lens_json, source_key, lex_turn_ids=()):
+    # One row per transcript turn, in conversation order. Amazon Lex turns are told apart by their IDs.
+    contact_id = contact_lens_json['CustomerMetadata']['ContactId']
+    participant_roles = dict()
+    for participant in contact_lens_json.get('Participants') or []:
+        participant_roles[participant.get('ParticipantId')] = participant.get('ParticipantRole')
+
+    turns = []
+    for turn_index, transcript in enumerate(contact_lens_json['Transcript']):
+        turns.append((contact_id,
+                      turn_index,
+                      participant_roles.get(transcript.get('ParticipantId')),
+                      transcript.get('Content'),
+                      transcript.get('Id') in lex_turn_ids,
+                      source_key))
+    return turns
+
+
+def get_partition(file_name):
+    # Partition the corpus by conversation date, Hive style, so query engines can prune on it.
+    conversation_time = get_key_time(file_name)
+    return 'date=' + (conversation_time.strftime('%Y-%m-%d') if conversation_time else UNKNOWN_DATE)
+
+
+def encode_jsonl(rows):
+    lines = [json.dumps(dict(zip(TURN_COLUMNS, row))) for row in rows]
+    return compress(('\n'.join(lines) + '\n').encode('utf-8'), 'gzip')
+
+
+def encode_parquet(rows):
+    import pyarrow
+    import pyarrow.parquet
+
+    columns = list(zip(*rows))
+    table = pyarrow.Table.from_arrays([pyarrow.array(columns[0], pyarrow.string()),
+                                       pyarrow.array(columns[1], pyarrow.int32()),
+                                       pyarrow.array(columns[2], pyarrow.string()),
+                                       pyarrow.array(columns[3], pyarrow.string()),
+                                       pyarrow.array(columns[4], pyarrow.bool_()),
+                                       pyarrow.array(columns[5], pyarrow.string())],
+                                      names=TURN_COLUMNS)
+    buffer = io.BytesIO()
+    pyarrow.parquet.write_table(table, buffer, compression='zstd')
+    return buffer.getvalue()
+
+
+TURN_ENCODERS = {'jsonl': ('.jsonl.gz', encode_jsonl), 'parquet': ('.parquet', encode_parquet)}
+
+
+class TurnExportError(Exception):
+    # The transcript was written, but its turns could not be exported. Its key shows up with this error type in the
+    # dead-letter file, to be exported again.
+    pass
+
+
+class TurnExportSink:
+    # Passes every transcript on to the wrapped output sink and also collects its turns, which are written in the
+    # same pass as a few large, partitioned files of up to rows_per_file turns each: gzipped JSON lines, or Parquet
+    # when pyarrow is installed. Analysis then reads these instead of every per-contact object.
+    #
+    # Like packs, the turns of a transcript only count as written once their file is stored, so checkpoints are held
+    # back until every turn of the checkpointed pages has been flushed. Turns that cannot be stored go back into the
+    # buffer and are stored with the next files, and the checkpoint keeps waiting for them.
+    def __init__(self, output_sink, storage, prefix, export_format=DEFAULT_TURN_EXPORT_FORMAT,
+                 rows_per_file=DEFAULT_TURN_EXPORT_ROWS, shard_tag=None):
+        if export_format not in TURN_ENCODERS:
+            raise ValueError('Unknown turn export format [{0}], expected one of {1}'.format(export_format,
+                                                                                           TURN_EXPORT_FORMATS))
+        if export_format == 'parquet':
+            try:
+                import pyarrow.parquet
+            except ImportError:
+                raise ValueError('The parquet turn export format requires the pyarrow package (pip install pyarrow)')
+        if rows_per_file < 1:
+            raise ValueError('rows_per_file must be at least 1')
+        if prefix and not prefix.endswith('/'):
+            prefix = prefix + '/'
+        self.output_sink = output_sink
+        self.storage = storage
+        self.prefix = prefix
+        self.export_format = export_format
+        self.rows_per_file = rows_per_file
+        self.files = 0
+        self.exported_turns = 0
+        self._run_id = str(int(time.time() * 1000))
+        if shard_tag:
+            self._run_id = self._run_id + '-' + shard_tag
+        self._partitions = dict()
+        self._buffered_rows = 0
+        self._pending_checkpoint = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def write(self, s3_object, file_name, body, fingerprint=None):
+        self.output_sink.write(s3_object, file_name, body, fingerprint)
+
+    def export(self, file_name, turns):
+        # Called once the transcript itself was written, so a failed upload leaves no turns behind.
+        try:
+            partition = get_partition(file_name)
+        except ValueError as error:
+            raise TurnExportError('Failed to export the turns of [{0}]: {1}'.format(file_name, error))
+        with self._lock:
+            self._partitions.setdefault(partition, []).extend(turns)
+            self._buffered_rows = self._buffered_rows + len(turns)
+            full = self._buffered_rows >= self.rows_per_file
+        if full:
+            try:
+                self.flush()
+            except Exception as error:
+                # These turns are still buffered, so the transcript has not failed. The run fails if close() cannot
+                # store them.
+                print('[ERROR] Failed to store turn export files, retrying with the next files: {0}'.format(error))
+
+    def checkpoint(self, last_key):
+        with self._lock:
+            self._pending_checkpoint = last_key
+            flushed = not self._buffered_rows
+        if flushed:
+            self.flush()
+
+    def flush(self):
+        # Every partition is flushed together, so a checkpoint never waits on a partition that fills slowly. Keys are
+        # listed in order, and date-based key layouts keep the number of partitions open at once small.
+        with self._flush_lock:
+            with self._lock:
+                partitions = self._partitions
+                self._partitions = dict()
+                self._buffered_rows = 0
+                last_key = self._pending_checkpoint
+                self._pending_checkpoint = None
+            try:
+                for partition in sorted(partitions):
+                    self._write_file(partition, partitions[partition])
+                    del partitions[partition]
+                if last_key is not None:
+                    self.output_sink.checkpoint(last_key)
+            except Exception:
+                # Put back every partition that was not stored, ahead of what was buffered since, and keep the
+                # checkpoint.
+                with self._lock:
+                    for partition, rows in partitions.items():
+                        self._partitions[partition] = rows + self._partitions.get(partition, [])
+                        self._buffered_rows = self._buffered_rows + len(rows)
+                    if self._pending_checkpoint is None:
+                        self._pending_checkpoint = last_key
+                raise
+
+    def _write_file(self, partition, rows):
+        # Order the rows by contact, so the file does not depend on which transcript finished first.
+        rows.sort(key=lambda row: (row[5], row[1]))
+        extension, encode = TURN_ENCODERS[self.export_format]
+        self.files = self.files + 1
+        file_key = '{}{}/turns-{}-{:06d}{}'.format(self.prefix, partition, self._run_id, self.files, extension)
+        self.storage.put(file_key, encode(rows))
+        self.exported_turns = self.exported_turns + len(rows)
+
+    def close(self):
+        self.flush()
+        self.output_sink.close()